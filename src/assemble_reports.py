@@ -0,0 +1,151 @@
+import base64
+import functools
+import io
+import os
+import string
+import warnings
+
+from datetime import date
+from html import escape as escape_html
+
+from render_reports import CREDENTIALS_FILE, OUTPUT_DIR, SRC_DIR, get_output_file, log
+from update_yaml_files import open_file, update_settings
+from utils import *
+
+# mirrors final_report_template.qmd, which stays the reference rendering path
+HTML_TEMPLATE_FILE = os.path.join(SRC_DIR, "report_template.html")
+QUARTO_FILE = os.path.join(SRC_DIR, "_quarto.yml")
+
+COLS_N = 3
+TABLE_FONT = "Inconsolata"
+TABLE_FONT_SIZE = 14
+TABLE_DASHED = False
+TABLE_SCROLLABLE = False
+PLOT_FONT = "Ayuthaya"
+PLOT_DPI = 300
+SCORE_MIN = 0
+SCORE_MAX = 10
+
+@functools.lru_cache(maxsize=None)
+def load_html_template(file_name=HTML_TEMPLATE_FILE):
+    with open(file_name) as file:
+        return string.Template(file.read())
+
+def render_value_box_png(data, font=PLOT_FONT, dpi=PLOT_DPI):
+    import matplotlib.pyplot as plt
+
+    figure = create_value_box_plot(data, font=font).draw()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png", dpi=dpi, bbox_inches="tight")
+    plt.close(figure)
+
+    encoded = base64.b64encode(buffer.getvalue()).decode()
+    return f'<img src="data:image/png;base64,{encoded}" alt="Summary of your data">'
+
+def render_value_boxes(data, value_boxes="plot", dpi=PLOT_DPI):
+    if value_boxes == "html":
+        return create_value_box_html(data, font=PLOT_FONT)
+    return render_value_box_png(data, dpi=dpi)
+
+def render_table(table_args, tables="gt"):
+    if tables == "virtual":
+        return create_virtual_table(**table_args)
+    if tables == "html":
+        return create_html_table(**table_args)
+    return create_data_table(**table_args).as_raw_html()
+
+def assemble_report(pid, participant_data, value_boxes="plot", tables="gt", dpi=PLOT_DPI):
+    settings = update_settings(open_file(QUARTO_FILE), pid)
+    goodness_hexcodes, fitbit_hexcodes = get_score_hexcodes(SCORE_MIN, SCORE_MAX)
+    phase1_cols_widths, phase2_cols_widths = get_cols_widths(pid, n_cols=COLS_N)
+    activity_names = participant_data["activity_names"]
+
+    phase1_data, temp_cols, phase1_cols_mapping = format_phase1_data(participant_data["phase1"], activity_names, n_cols=COLS_N)
+    if phase1_data.empty:
+        phase1_cols_widths = {k: v for k, v in phase1_cols_widths.items() if not k.startswith("temp")}
+    phase2_data = format_phase2_data(participant_data["phase2"], activity_names)
+    phase2_extra_data = format_phase2_extra_data(participant_data["phase2_extra"], activity_names)
+    phase1_table_data, phase2_table_data = get_table_data(phase1_data, phase2_data, temp_cols)
+
+    table_args = dict(
+        goodness_hexcodes=goodness_hexcodes,
+        fitbit_hexcodes=fitbit_hexcodes,
+        font=TABLE_FONT,
+        font_size=TABLE_FONT_SIZE,
+        dashed=TABLE_DASHED,
+        scrollable=TABLE_SCROLLABLE
+    )
+    phase1_table_args = dict(table_args, data=phase1_table_data, cols_widths=phase1_cols_widths, cols_labels=phase1_cols_mapping)
+    phase2_table_args = dict(table_args, data=phase2_table_data, cols_widths=phase2_cols_widths, cols_labels={"Day of week": "Day", "Goodness rating": "Goodness"})
+
+    # great_tables tables only name the table font, so its @font-face rules go in the page head with the theme font
+    font_css = [get_font_css(THEME_FONT)]
+    if tables == "gt":
+        font_css.append(get_font_css(TABLE_FONT))
+
+    return load_html_template().substitute(
+        title=escape_html(settings["title"]),
+        author=escape_html(settings["author"]),
+        date=date.today().strftime("%B %-d, %Y"),
+        link_color=settings["format"]["html"]["linkcolor"],
+        font_css="\n".join(css for css in font_css if css),
+        phase1_value_boxes=render_value_boxes(get_value_box_data_from_metrics(participant_data["metrics"], phase=1), value_boxes, dpi),
+        phase1_table=render_table(phase1_table_args, tables),
+        activity_list=escape_html(str(phase2_extra_data["activity_list"][0])),
+        phase2_value_boxes=render_value_boxes(get_value_box_data_from_metrics(participant_data["metrics"], phase=2), value_boxes, dpi),
+        phase2_table=render_table(phase2_table_args, tables)
+    )
+
+def assemble_reports(pids, cohort_data, output_dir=OUTPUT_DIR, value_boxes="plot", tables="gt", dpi=PLOT_DPI):
+    warnings.filterwarnings("ignore")
+    os.makedirs(output_dir, exist_ok=True)
+
+    failures = {}
+    for pid in pids:
+        try:
+            report = assemble_report(pid, get_participant_data(cohort_data, pid), value_boxes, tables, dpi)
+            output_path = os.path.join(output_dir, get_output_file(pid))
+            with open(output_path, "w") as file:
+                file.write(report)
+            log(f"Assembled final study report for participant {pid} to {output_path}")
+        except Exception as err:
+            failures[pid] = str(err)
+            log(f"Failed to assemble final study report for participant {pid}")
+    return failures
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pids", nargs="+")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--cohort-data", default=None, help="use a saved bulk extraction instead of querying the database")
+    parser.add_argument("--group", default="balance")
+    parser.add_argument("--snapshot", default=None, help="read from a local snapshot instead of the study database")
+    parser.add_argument("--value-boxes", choices=["plot", "html"], default="plot")
+    parser.add_argument("--tables", choices=["gt", "html", "virtual"], default="gt")
+    parser.add_argument("--fitbit-source", choices=["daily", "intraday"], default="daily")
+    parser.add_argument("--dpi", type=int, default=PLOT_DPI, help="resolution of the value box images")
+    args = parser.parse_args()
+
+    if args.cohort_data:
+        cohort_data = load_cohort_data(args.cohort_data)
+    else:
+        log(f"Extracting data for {len(args.pids)} participants")
+        if args.snapshot:
+            con = connect_to_snapshot(os.path.abspath(args.snapshot))
+        else:
+            con = connect_to_database(load_credentials(args.group, CREDENTIALS_FILE))
+        cohort_data = extract_cohort_data(con, pids=args.pids, fitbit_source=args.fitbit_source)
+        con.close()
+
+    log(f"Assembling final study reports for {len(args.pids)} participants")
+    failures = assemble_reports(args.pids, cohort_data, args.output_dir, args.value_boxes, args.tables, args.dpi)
+
+    for pid, err in failures.items():
+        print(f"{pid}: {err}", file=sys.stderr)
+
+    log("All done!" if not failures else f"Done with {len(failures)} failures")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,92 @@
+import os
+import re
+import subprocess
+import sys
+
+from utils import ASSETS_DIR, GOOGLE_FONT_OPTIONS, PLOT_FALLBACK_FONT, THEME_FONT, get_font_css, get_font_file_name
+
+# matplotlib's font list is built once here and reused by every render (see render_reports.run_quarto)
+MPL_CONFIG_DIR = os.path.join(ASSETS_DIR, "matplotlib")
+
+# request woff2 files, which every browser we target supports and which are the smallest to embed
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+FONT_WEIGHTS = "400;700"
+
+def fetch_font(font):
+    import requests
+
+    family = font.replace(" ", "+")
+    response = requests.get(
+        f"https://fonts.googleapis.com/css2?family={family}:wght@{FONT_WEIGHTS}&display=swap",
+        headers={"User-Agent": USER_AGENT}
+    )
+    response.raise_for_status()
+    css = response.text
+
+    source_file = get_font_file_name(font, ".css")
+    os.makedirs(os.path.dirname(source_file), exist_ok=True)
+
+    for i, url in enumerate(dict.fromkeys(re.findall(r"url\((https://[^)]+)\)", css))):
+        font_file = os.path.basename(get_font_file_name(font, f"-{i}.woff2"))
+        font_response = requests.get(url)
+        font_response.raise_for_status()
+        with open(os.path.join(os.path.dirname(source_file), font_file), "wb") as file:
+            file.write(font_response.content)
+        css = css.replace(url, font_file)
+
+    with open(source_file, "w") as file:
+        file.write(css)
+
+    # drop any stale pre-encoded copy
+    embedded_file = get_font_file_name(font, ".embedded.css")
+    if os.path.exists(embedded_file):
+        os.remove(embedded_file)
+
+def fetch_plot_font(font):
+    import requests
+
+    # without a browser user agent Google Fonts serves truetype files, which matplotlib can read
+    family = font.replace(" ", "+")
+    response = requests.get(f"https://fonts.googleapis.com/css2?family={family}:wght@{FONT_WEIGHTS}")
+    response.raise_for_status()
+
+    os.makedirs(os.path.dirname(get_font_file_name(font, ".ttf")), exist_ok=True)
+    for i, url in enumerate(dict.fromkeys(re.findall(r"url\((https://[^)]+\.ttf)\)", response.text))):
+        font_response = requests.get(url)
+        font_response.raise_for_status()
+        with open(get_font_file_name(font, f"-{i}.ttf"), "wb") as file:
+            file.write(font_response.content)
+
+def build_font_cache():
+    # importing the font manager in a fresh interpreter writes matplotlib's font list cache to MPL_CONFIG_DIR
+    os.makedirs(MPL_CONFIG_DIR, exist_ok=True)
+    env = dict(os.environ, MPLCONFIGDIR=MPL_CONFIG_DIR)
+    subprocess.run([sys.executable, "-c", "import matplotlib.font_manager"], env=env, check=True)
+
+def build_assets():
+    missing = []
+    for font in GOOGLE_FONT_OPTIONS + [THEME_FONT]:
+        if get_font_css(font) is None:
+            missing.append(font)
+
+    build_font_cache()
+    return missing
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["fetch", "build"], help="fetch: download fonts into the asset cache (needs network access); build: pre-encode cached fonts for embedding")
+    args = parser.parse_args()
+
+    if args.command == "fetch":
+        for font in GOOGLE_FONT_OPTIONS + [THEME_FONT]:
+            print(f"Fetching {font}")
+            fetch_font(font)
+        print(f"Fetching {PLOT_FALLBACK_FONT} for plots")
+        fetch_plot_font(PLOT_FALLBACK_FONT)
+
+    missing = build_assets()
+    for font in missing:
+        print(f"{font} is not in the asset cache at {ASSETS_DIR}; reports will fetch it from Google Fonts")
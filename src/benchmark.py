@@ -0,0 +1,145 @@
+import io
+import json
+import os
+import platform
+import shutil
+import time
+
+import pandas as pd
+
+from utils import *
+
+SYNTHETIC_FILE = "../snapshot/synthetic.duckdb"
+COLS_N = 3
+
+class StageTimer:
+    def __init__(self):
+        self.seconds = {}
+
+    def time(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.seconds.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        return {
+            stage: {"n": len(seconds), "total_seconds": sum(seconds), "mean_seconds": sum(seconds) / len(seconds), "max_seconds": max(seconds)}
+            for stage, seconds in self.seconds.items()
+        }
+
+def read_participant_data(con, pid, max_workers=QUERY_WORKERS):
+    queries = generate_queries(pid=pid, dialect=con.dialect.name)
+    return read_queries(con, queries, max_workers=max_workers)
+
+def render_value_box_plot(data, dpi):
+    import matplotlib.pyplot as plt
+
+    figure = create_value_box_plot(data).draw()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png", dpi=dpi)
+    plt.close(figure)
+    return buffer.getvalue()
+
+def benchmark_report_stages(timer, con, pids, activity_names, dpi):
+    goodness_hexcodes, fitbit_hexcodes = get_score_hexcodes()
+
+    for pid in pids:
+        timer.time("sql_extraction_sequential", read_participant_data, con, pid, 1)
+        data = timer.time("sql_extraction", read_participant_data, con, pid)
+
+        phase1_data, temp_cols, phase1_cols_mapping = timer.time("phase1_formatting", format_phase1_data, data["phase1"], activity_names, COLS_N)
+        phase2_data = timer.time("phase2_formatting", format_phase2_data, data["phase2"], activity_names)
+
+        phase1_value_box_data = timer.time("get_value_box_data", get_value_box_data, data["phase1"], 1, data["phase1_extra"])
+        phase2_value_box_data = timer.time("get_value_box_data", get_value_box_data, data["phase2"], 2)
+
+        for value_box_data in [phase1_value_box_data, phase2_value_box_data]:
+            timer.time("create_value_box_plot", render_value_box_plot, value_box_data, dpi)
+            timer.time("create_value_box_html", create_value_box_html, value_box_data)
+
+        phase1_cols_widths, phase2_cols_widths = get_cols_widths(pid, COLS_N)
+        phase1_table_data, phase2_table_data = get_table_data(phase1_data, phase2_data, temp_cols)
+        tables = [
+            (phase1_table_data, phase1_cols_mapping, phase1_cols_widths),
+            (phase2_table_data, {"Day of week": "Day", "Goodness rating": "Goodness"}, phase2_cols_widths)
+        ]
+        for table_data, cols_labels, cols_widths in tables:
+            table_args = dict(
+                data=table_data,
+                cols_labels=cols_labels,
+                cols_widths=cols_widths,
+                goodness_hexcodes=goodness_hexcodes,
+                fitbit_hexcodes=fitbit_hexcodes
+            )
+            timer.time("create_data_table", lambda: create_data_table(**table_args).as_raw_html())
+            timer.time("create_html_table", create_html_table, **table_args)
+
+def benchmark_full_render(timer, snapshot, pids):
+    from render_reports import render_report
+
+    output_dir = os.path.abspath("../output/benchmark")
+    for pid in pids:
+        timer.time("full_render", render_report, pid, output_dir, {"snapshot": os.path.abspath(snapshot)})
+
+def run_benchmark(snapshot, n_report_pids=10, n_render_pids=0, dpi=300):
+    timer = StageTimer()
+    con = connect_to_snapshot(os.path.abspath(snapshot))
+
+    all_pids = pd.read_sql(sql=text("select distinct pId from user_study_phases order by pId"), con=con)["pId"].astype(str).tolist()
+    report_pids = all_pids[:n_report_pids]
+
+    activity_names = timer.time("load_activity_names", load_activity_names, con)
+    cohort_data = timer.time("bulk_extraction", extract_cohort_data, con, None, activity_names)
+    timer.time("cohort_metrics", compute_value_box_metrics, cohort_data["phase1"], cohort_data["phase1_extra"], cohort_data["phase2"])
+
+    benchmark_report_stages(timer, con, report_pids, activity_names, dpi)
+
+    if n_render_pids > 0:
+        if shutil.which("quarto") is None:
+            print("quarto not found; skipping full render benchmark")
+        else:
+            benchmark_full_render(timer, snapshot, report_pids[:n_render_pids])
+
+    con.close()
+
+    return {
+        "config": {
+            "snapshot": snapshot,
+            "n_participants": len(all_pids),
+            "n_report_pids": len(report_pids),
+            "n_render_pids": n_render_pids,
+            "dpi": dpi,
+            "python": platform.python_version(),
+            "pandas": pd.__version__
+        },
+        "row_counts": {name: int(data.shape[0]) for name, data in cohort_data.items()},
+        "stages": timer.summary()
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--snapshot", default=SYNTHETIC_FILE, help="database to benchmark against (generated if missing)")
+    parser.add_argument("--participants", type=int, default=1000, help="participants to generate when the database is missing")
+    parser.add_argument("--days", type=int, default=365, help="days per participant to generate when the database is missing")
+    parser.add_argument("--report-pids", type=int, default=10, help="participants to run the per-report stages for")
+    parser.add_argument("--render-pids", type=int, default=0, help="participants to render end to end with Quarto")
+    parser.add_argument("--dpi", type=int, default=300, help="resolution for rasterizing value box plots")
+    parser.add_argument("--output", default=None, help="write results to this JSON file instead of stdout")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.snapshot):
+        from generate_synthetic_data import generate_synthetic_data, write_synthetic_database
+
+        write_synthetic_database(generate_synthetic_data(args.participants, args.days), args.snapshot)
+
+    results = run_benchmark(args.snapshot, args.report_pids, args.render_pids, args.dpi)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,70 @@
+import json
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from utils import create_data_table, create_html_table, get_cols_widths, get_score_hexcodes
+
+# tables are sized and coloured exactly as in the reports, for a participant without column overrides
+PID = "101"
+COLS_N = 3
+COLS_LABELS = {"Day of week": "Day", "Goodness rating": "Goodness"}
+
+def generate_table_data(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2024-01-01", periods=n_rows, freq="D")
+    activities = np.array(["-&nbsp;Walk", "-&nbsp;Read<br>-&nbsp;Cook", "-&nbsp;Yoga<br>-&nbsp;Call a friend<br>-&nbsp;Garden"])
+
+    return pd.DataFrame({
+        "Day of week": dates.strftime("%a"),
+        "Date": dates.date,
+        "Goodness rating": pd.array(rng.integers(0, 11, n_rows), dtype="Int64"),
+        "Planned activities": rng.choice(activities, n_rows),
+        "Completed activities": rng.choice(activities, n_rows),
+        "Morning plan": "Planning to get outside before lunch",
+        "Evening note": "Felt good after the walk",
+        "Steps": np.where(rng.random(n_rows) < 0.1, np.nan, rng.integers(1000, 15000, n_rows)),
+        "Sleep": np.where(rng.random(n_rows) < 0.1, np.nan, rng.integers(4, 10, n_rows))
+    })
+
+def benchmark_tables(n_rows_list, repeat=5):
+    goodness_hexcodes, fitbit_hexcodes = get_score_hexcodes()
+    _, phase2_cols_widths = get_cols_widths(PID, COLS_N)
+
+    results = []
+    for n_rows in n_rows_list:
+        table_args = dict(
+            data=generate_table_data(n_rows),
+            cols_labels=COLS_LABELS,
+            cols_widths=phase2_cols_widths,
+            goodness_hexcodes=goodness_hexcodes,
+            fitbit_hexcodes=fitbit_hexcodes
+        )
+
+        gt_html = create_data_table(**table_args).as_raw_html()
+        fast_html = create_html_table(**table_args)
+
+        gt_seconds = min(timeit.repeat(lambda: create_data_table(**table_args).as_raw_html(), number=1, repeat=repeat))
+        fast_seconds = min(timeit.repeat(lambda: create_html_table(**table_args), number=1, repeat=repeat))
+
+        results.append({
+            "n_rows": n_rows,
+            "gt_seconds": gt_seconds,
+            "html_seconds": fast_seconds,
+            "speedup": gt_seconds / fast_seconds,
+            "gt_bytes": len(gt_html.encode()),
+            "html_bytes": len(fast_html.encode())
+        })
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[30, 120, 365, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(json.dumps(benchmark_tables(args.rows, args.repeat), indent=2))
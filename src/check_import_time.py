@@ -0,0 +1,58 @@
+import os
+import re
+import subprocess
+import sys
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# seconds allowed for `import utils` in a fresh interpreter, i.e. the fixed cost every report kernel pays before any work
+IMPORT_TIME_BUDGET = 1.5
+
+# libraries only the plot and table functions need; importing utils must not pull them in
+LAZY_MODULES = ["plotnine", "matplotlib", "great_tables"]
+
+def measure_import(module="utils"):
+    # -X importtime reports cumulative microseconds per module on stderr
+    check_lazy = f"import sys; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}; {check_lazy}"],
+        cwd=SRC_DIR, check=True, capture_output=True, text=True
+    )
+
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)", line)
+        if match:
+            cumulative[match.group(2)] = int(match.group(1)) / 1e6
+
+    loaded_lazy_modules = [name for name in result.stdout.strip().split(",") if name]
+    return cumulative[module], loaded_lazy_modules, cumulative
+
+def check_import_time(module="utils", budget=IMPORT_TIME_BUDGET):
+    seconds, loaded_lazy_modules, cumulative = measure_import(module)
+    slowest = sorted(((name, time) for name, time in cumulative.items() if "." not in name and name != module), key=lambda x: -x[1])[:5]
+
+    print(f"import {module}: {seconds:.3f}s (budget {budget:.3f}s)")
+    for name, time in slowest:
+        print(f"  {name}: {time:.3f}s")
+
+    problems = []
+    if seconds > budget:
+        problems.append(f"import {module} took {seconds:.3f}s, over the {budget:.3f}s budget")
+    if loaded_lazy_modules:
+        problems.append(f"import {module} eagerly loaded {', '.join(loaded_lazy_modules)}")
+    return problems
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="utils")
+    parser.add_argument("--budget", type=float, default=IMPORT_TIME_BUDGET, help="seconds")
+    args = parser.parse_args()
+
+    problems = check_import_time(args.module, args.budget)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    sys.exit(1 if problems else 0)
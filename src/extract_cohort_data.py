@@ -0,0 +1,28 @@
+from utils import load_credentials, connect_to_database, connect_to_snapshot, extract_cohort_data, save_cohort_data, summarize_cohort_metrics
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pids", nargs="*", help="participant IDs to extract (default: whole cohort)")
+    parser.add_argument("--output", default="../output/cohort_data.pkl")
+    parser.add_argument("--group", default="balance")
+    parser.add_argument("--snapshot", default=None, help="read from a local snapshot instead of the study database")
+    parser.add_argument("--fitbit-source", choices=["daily", "intraday"], default="daily", help="take steps, sleep and wear time from the daily fitbit summaries or aggregate them from intraday records")
+    parser.add_argument("--summary", default=None, help="write a cohort summary of the value box statistics to this CSV file")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        con = connect_to_snapshot(args.snapshot)
+    else:
+        credentials = load_credentials(args.group)
+        con = connect_to_database(credentials)
+
+    cohort_data = extract_cohort_data(con, pids=args.pids or None, fitbit_source=args.fitbit_source)
+    save_cohort_data(cohort_data, args.output)
+
+    if args.summary:
+        summarize_cohort_metrics(cohort_data["metrics"]).to_csv(args.summary, index=False)
+
+    print(f"Extracted data for {cohort_data['phase1']['pId'].nunique()} participants to {args.output}")
@@ -0,0 +1,166 @@
+import os
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+from utils import EXPECTED_INDEXES, INTRADAY_FITBIT_TABLE
+
+SYNTHETIC_FILE = "../snapshot/synthetic.duckdb"
+START_DATE = "2024-01-01"
+
+ACTIVITY_NAMES = [
+    "walk the dog", "Yard Work", "read a book", "Go to Therapy", "cook dinner", "call a friend",
+    "Weight Training", "yoga", "Word Searches", "Playing Guitar", "garden", "Riding Bike",
+    "Spending time with family", "Internet Research", "Outside Tasks", "watch a movie"
+]
+
+# probability that a participant completes a given survey or wears their fitbit on a given day
+SURVEY_PROBABILITY = 0.85
+FITBIT_PROBABILITY = 0.8
+NAP_PROBABILITY = 0.2
+
+INTRADAY_INDEX = f"create index idx_fitbit_intraday_data_pid_datetime on {INTRADAY_FITBIT_TABLE} (pId, dateTime, fitbitDataType)"
+
+def _participant_days(pids, starts, n_days):
+    return pd.DataFrame({
+        "pId": np.repeat(pids, n_days),
+        "date": (np.repeat(starts, n_days) + np.tile(pd.to_timedelta(np.arange(n_days), unit="D"), len(pids)))
+    })
+
+def generate_phases(pids, starts, phase1_days, phase2_days):
+    phase1_end = starts + pd.Timedelta(days=phase1_days)
+    phase2_end = phase1_end + pd.Timedelta(days=phase2_days)
+
+    # end dates are exclusive, as in the study database
+    return pd.concat([
+        pd.DataFrame({"pId": pids, "phaseId": "PHASE_1", "startDate": starts, "endDate": phase1_end}),
+        pd.DataFrame({"pId": pids, "phaseId": "PHASE_2", "startDate": phase1_end, "endDate": phase2_end})
+    ], ignore_index=True)
+
+def generate_surveys(days, sId, rng):
+    surveys = days[rng.random(days.shape[0]) < SURVEY_PROBABILITY].reset_index(drop=True)
+    n = surveys.shape[0]
+
+    surveys["surveyId"] = surveys["pId"] + f"_{sId}_" + surveys["date"].dt.strftime("%Y%m%d")
+    surveys["sId"] = sId
+    surveys["goodnessScore"] = rng.integers(-1, 11, n) if sId != "MORNING" else -1
+    surveys["note"] = np.where(rng.random(n) < 0.5, "  had a good day outside ", None)
+    return surveys
+
+def generate_details(surveys, activity_ids, rng):
+    n_activities = rng.poisson(2.5, surveys.shape[0])
+    return pd.DataFrame({
+        "surveyId": np.repeat(surveys["surveyId"].to_numpy(), n_activities),
+        "activityId": rng.choice(activity_ids, n_activities.sum()),
+        "score": rng.integers(-1, 11, n_activities.sum())
+    })
+
+def generate_fitbit(days, rng):
+    n = days.shape[0]
+    worn = rng.random(n) < FITBIT_PROBABILITY
+
+    return pd.concat([
+        days.assign(fitbitDataType="heartrate", value=np.where(worn, rng.integers(55, 90, n), 0)),
+        days.assign(fitbitDataType="steps", value=np.where(worn, rng.integers(1000, 15000, n), 0)),
+        days.assign(fitbitDataType="sleep", value=np.where(worn, rng.integers(4, 10, n), 0))
+    ], ignore_index=True)
+
+def _minute_records(days, minutes, fitbitDataType, value):
+    offsets = pd.to_timedelta(minutes, unit="min")
+    return pd.DataFrame({
+        "pId": np.repeat(days["pId"].to_numpy(), len(offsets)),
+        "dateTime": np.repeat(days["date"].to_numpy(), len(offsets)) + np.tile(offsets, days.shape[0]),
+        "fitbitDataType": fitbitDataType,
+        "value": value
+    })
+
+def generate_intraday_fitbit(days, rng):
+    # minute-level records on the days the fitbit is worn: heart rate and steps while awake from 7am to 11pm,
+    # sleep from 11pm until 7am the next morning, and an afternoon nap on some days
+    worn = days[rng.random(days.shape[0]) < FITBIT_PROBABILITY].reset_index(drop=True)
+    napped = worn[rng.random(worn.shape[0]) < NAP_PROBABILITY].reset_index(drop=True)
+    awake = np.arange(7 * 60, 23 * 60)
+    n_awake = worn.shape[0] * len(awake)
+
+    return pd.concat([
+        _minute_records(worn, awake, "heartrate", rng.integers(55, 90, n_awake)),
+        _minute_records(worn, awake, "steps", rng.integers(0, 20, n_awake)),
+        _minute_records(worn, np.arange(23 * 60, 31 * 60), "sleep", 1),
+        _minute_records(napped, np.arange(14 * 60, 15 * 60), "sleep", 1)
+    ], ignore_index=True)
+
+def generate_synthetic_data(n_participants=1000, n_days=365, seed=0, intraday=False):
+    rng = np.random.default_rng(seed)
+
+    pids = np.array([str(1000 + i) for i in range(n_participants)], dtype=object)
+    starts = pd.Timestamp(START_DATE) + pd.to_timedelta(rng.integers(0, 90, n_participants), unit="D")
+    phase1_days = n_days // 2
+    phase2_days = n_days - phase1_days
+
+    activities = pd.DataFrame({"activityId": [f"A{i}" for i in range(len(ACTIVITY_NAMES))], "name": ACTIVITY_NAMES})
+    user_activities = pd.DataFrame({"activityId": [f"U{i}" for i in range(10)], "name": [f"  my activity {i}" for i in range(10)]})
+    activity_ids = np.concatenate([activities["activityId"], user_activities["activityId"]])
+
+    phase1 = _participant_days(pids, starts, phase1_days)
+    phase2 = _participant_days(pids, starts + pd.Timedelta(days=phase1_days), phase2_days)
+
+    survey_responses = pd.concat([
+        generate_surveys(phase1, "DAILY", rng),
+        generate_surveys(phase2, "MORNING", rng),
+        generate_surveys(phase2, "EVENING", rng)
+    ], ignore_index=True)
+
+    preferences = pd.DataFrame({
+        "participantPhaseId": np.repeat(pids + "_PHASE_2", 4),
+        "activityId": rng.choice(activity_ids, n_participants * 4)
+    }).drop_duplicates()
+
+    tables = {
+        "user_study_phases": generate_phases(pids, starts, phase1_days, phase2_days),
+        "survey_responses": survey_responses.filter(["surveyId", "pId", "sId", "date", "goodnessScore", "note"], axis=1),
+        "survey_response_details": generate_details(survey_responses, activity_ids, rng),
+        "activities": activities,
+        "user_activities": user_activities,
+        "user_activity_preferences": preferences,
+        "fitbit_data": generate_fitbit(pd.concat([phase1, phase2], ignore_index=True), rng)
+    }
+    if intraday:
+        tables[INTRADAY_FITBIT_TABLE] = generate_intraday_fitbit(pd.concat([phase1, phase2], ignore_index=True), rng)
+    return tables
+
+def write_synthetic_database(tables, file_name=SYNTHETIC_FILE):
+    os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+    if os.path.exists(file_name):
+        os.remove(file_name)
+
+    with duckdb.connect(file_name) as con:
+        for table, data in tables.items():
+            con.register("new_rows", data)
+            date_columns = [col for col in ["date", "startDate", "endDate"] if col in data.columns]
+            replace = f"replace ({', '.join(f'cast({col} as date) as {col}' for col in date_columns)})" if date_columns else ""
+            con.execute(f"create table {table} as select * {replace} from new_rows")
+            con.unregister("new_rows")
+
+        for index in EXPECTED_INDEXES:
+            con.execute(index)
+        if INTRADAY_FITBIT_TABLE in tables:
+            con.execute(INTRADAY_INDEX)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--participants", type=int, default=1000)
+    parser.add_argument("--days", type=int, default=365, help="days per participant, split evenly between the two phases")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=SYNTHETIC_FILE)
+    parser.add_argument("--intraday", action="store_true", help="also generate minute-level fitbit records (about 2,400 rows per participant day)")
+    args = parser.parse_args()
+
+    tables = generate_synthetic_data(args.participants, args.days, args.seed, args.intraday)
+    write_synthetic_database(tables, args.output)
+
+    for table, data in tables.items():
+        print(f"{table}: {data.shape[0]} rows")
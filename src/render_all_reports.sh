@@ -25,10 +25,5 @@ pids=(
     123
 )
 
-for pid in "${pids[@]}" ;
-do
-    echo "[$(date '+%Y-%m-%d %H:%M:%S')] Rendering final study report for participant $pid"
-    bash render_participant_report.sh $pid 
-done
-
-echo "[$(date '+%Y-%m-%d %H:%M:%S')] All done!"
\ No newline at end of file
+# render each participant in its own scratch directory, in parallel across all cores
+python render_reports.py "${pids[@]}" --bulk "$@"
\ No newline at end of file
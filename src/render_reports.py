@@ -0,0 +1,376 @@
+import hashlib
+import json
+import os
+import psutil
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from shared_assets import COMPRESSION_FORMATS, SHARED_ASSETS_QUARTO_ARGS, precompress, share_report_assets
+from update_yaml_files import update_header, update_params
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_DIR = os.path.abspath(os.path.join(SRC_DIR, "..", "output"))
+CREDENTIALS_FILE = os.path.abspath(os.path.join(SRC_DIR, "..", "credentials.yaml"))
+
+TEMPLATE_FILE = "final_report_template.qmd"
+RENDER_FILES = [TEMPLATE_FILE, "utils.py", "_quarto.yml", "params.yml", "theme.scss"]
+ASSETS_DIR = os.path.join(SRC_DIR, "assets")
+
+# inputs other than the participant's data that change every report when edited
+MANIFEST_FILE = os.path.join(OUTPUT_DIR, "build_manifest.json")
+MANIFEST_INPUT_FILES = [TEMPLATE_FILE, "utils.py", "_quarto.yml", "theme.scss"]
+MANIFEST_IGNORED_PARAMS = ["credentials_file", "snapshot", "cohort_data", "trace_file"]
+
+TRACE_DIR = os.path.join(OUTPUT_DIR, "traces")
+HOTSPOTS_FILE = "hotspots.json"
+
+# how often the memory of a running Quarto render is sampled
+RSS_SAMPLE_SECONDS = 0.2
+
+def log(message):
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}", flush=True)
+
+def get_output_file(pid):
+    return f"balance_final_report_{pid}.html"
+
+def prepare_render_dir(pid, render_dir, params=None):
+    for file_name in RENDER_FILES:
+        shutil.copy(os.path.join(SRC_DIR, file_name), render_dir)
+
+    report_params = {"credentials_file": CREDENTIALS_FILE}
+    if params is not None:
+        report_params.update(params)
+
+    update_header(pid, os.path.join(render_dir, "_quarto.yml"))
+    update_params(pid, os.path.join(render_dir, "params.yml"), report_params)
+
+def run_quarto(render_dir, extra_args=None):
+    command = ["quarto", "render", TEMPLATE_FILE, "--execute-params", "params.yml", "--output-dir", "output"]
+    if extra_args is not None:
+        command += extra_args
+
+    # scratch copies of the project resolve fonts from the shared asset cache and reuse the prebuilt matplotlib font list
+    env = dict(os.environ, BALANCE_ASSETS_DIR=ASSETS_DIR, MPLCONFIGDIR=os.path.join(ASSETS_DIR, "matplotlib"))
+    process = subprocess.Popen(command, cwd=render_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    # the kernel and pandoc run under quarto, so memory is sampled across its whole process tree while it runs
+    peak_rss_mb = 0
+    while True:
+        try:
+            stdout, stderr = process.communicate(timeout=RSS_SAMPLE_SECONDS)
+            break
+        except subprocess.TimeoutExpired:
+            peak_rss_mb = max(peak_rss_mb, get_tree_rss_mb(process.pid))
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+    return peak_rss_mb
+
+def collect_output(pid, render_dir, output_dir=OUTPUT_DIR):
+    output_file = get_output_file(pid)
+    os.makedirs(output_dir, exist_ok=True)
+
+    output_path = os.path.join(output_dir, output_file)
+    shutil.move(os.path.join(render_dir, "output", output_file), output_path)
+    return output_path
+
+def get_tree_rss_mb(pid):
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+
+    rss = 0
+    for process in processes:
+        try:
+            rss += process.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss / 1024 ** 2
+
+def time_stage(stages, name, func, *args):
+    # current and sampled rss rather than ru_maxrss, which in a reused pool worker is the high-water mark of every earlier report
+    from utils import get_rss_mb, sample_peak_rss
+
+    rss_start = get_rss_mb()
+    start = time.perf_counter()
+    with sample_peak_rss() as peak:
+        result = func(*args)
+    rss_mb = get_rss_mb()
+    stages.append({
+        "stage": name, "rows": None, "seconds": time.perf_counter() - start,
+        "rss_mb": rss_mb, "rss_delta_mb": rss_mb - rss_start, "peak_rss_mb": peak["peak_rss_mb"]
+    })
+    return result
+
+def save_trace(pid, render_dir, runner_stages, trace_dir):
+    # the template's own stages are written by the kernel, Quarto and the final write are timed here
+    trace_file = os.path.join(render_dir, "trace.json")
+    trace = {"pid": str(pid), "stages": []}
+    if os.path.exists(trace_file):
+        with open(trace_file) as file:
+            trace = json.load(file)
+    trace["stages"] += runner_stages
+
+    os.makedirs(trace_dir, exist_ok=True)
+    with open(os.path.join(trace_dir, f"{pid}.json"), "w") as file:
+        json.dump(trace, file, indent=2)
+
+def render_report(pid, output_dir=OUTPUT_DIR, params=None, participant_data=None, render_dir=None, quarto_args=None, trace_dir=None, shared_assets=False, compress=None):
+    # by default every participant gets its own scratch copy of the project so renders never share YAML or output files
+    if render_dir is None:
+        with tempfile.TemporaryDirectory(prefix=f"balance_{pid}_") as scratch_dir:
+            return render_report(pid, output_dir, params, participant_data, scratch_dir, quarto_args, trace_dir, shared_assets, compress)
+
+    report_params = dict(params or {})
+    if trace_dir is not None:
+        report_params["trace_file"] = os.path.join(render_dir, "trace.json")
+
+    if participant_data is not None:
+        from utils import save_cohort_data
+
+        data_file = os.path.join(render_dir, "cohort_data.pkl")
+        save_cohort_data(participant_data, data_file)
+        report_params["cohort_data"] = data_file
+
+    prepare_render_dir(pid, render_dir, report_params)
+
+    runner_stages = []
+    if shared_assets:
+        quarto_args = list(quarto_args or []) + SHARED_ASSETS_QUARTO_ARGS
+    # quarto and its kernel run in child processes, so the render's peak is the one sampled across quarto's process tree
+    peak_rss_mb = time_stage(runner_stages, "quarto_render", run_quarto, render_dir, quarto_args)
+    runner_stages[-1]["peak_rss_mb"] = peak_rss_mb
+
+    if shared_assets:
+        rendered_file = os.path.join(render_dir, "output", get_output_file(pid))
+        time_stage(runner_stages, "share_assets", share_report_assets, rendered_file, output_dir, compress)
+
+    output_path = time_stage(runner_stages, "write_output", collect_output, pid, render_dir, output_dir)
+    if compress:
+        time_stage(runner_stages, "compress_output", precompress, output_path, compress)
+
+    if trace_dir is not None:
+        save_trace(pid, render_dir, runner_stages, trace_dir)
+    return output_path
+
+def aggregate_traces(trace_dir, pids=None):
+    import pandas as pd
+
+    records = []
+    for file_name in sorted(os.listdir(trace_dir)):
+        if not file_name.endswith(".json") or file_name == HOTSPOTS_FILE:
+            continue
+        with open(os.path.join(trace_dir, file_name)) as file:
+            trace = json.load(file)
+        if pids is None or trace["pid"] in pids:
+            records += [dict(stage, pid=trace["pid"]) for stage in trace["stages"]]
+
+    if not records:
+        return []
+
+    stages = pd.DataFrame(records).reindex(columns=["pid", "stage", "rows", "seconds", "rss_mb", "rss_delta_mb", "peak_rss_mb"])
+    grouped = stages.groupby("stage")
+    hotspots = pd.DataFrame({
+        "n": grouped["seconds"].size(),
+        "total_seconds": grouped["seconds"].sum(),
+        "mean_seconds": grouped["seconds"].mean(),
+        "p95_seconds": grouped["seconds"].quantile(0.95),
+        "max_seconds": grouped["seconds"].max(),
+        "slowest_pid": stages.loc[grouped["seconds"].idxmax(), ["stage", "pid"]].set_index("stage")["pid"],
+        "max_rss_mb": grouped["rss_mb"].max(),
+        "mean_rss_delta_mb": grouped["rss_delta_mb"].mean(),
+        "max_peak_rss_mb": grouped["peak_rss_mb"].max(),
+        "total_rows": grouped["rows"].sum(min_count=1)
+    })
+    hotspots["share_of_render"] = hotspots["total_seconds"] / stages.loc[stages["stage"] == "quarto_render", "seconds"].sum()
+    hotspots = hotspots.sort_values("total_seconds", ascending=False).reset_index()
+
+    # json has no NaN, so stages without row counts are written as null
+    return json.loads(hotspots.to_json(orient="records"))
+
+def save_hotspots(trace_dir, pids=None):
+    hotspots = aggregate_traces(trace_dir, pids)
+    with open(os.path.join(trace_dir, HOTSPOTS_FILE), "w") as file:
+        json.dump(hotspots, file, indent=2)
+    return hotspots
+
+def hash_files(file_names):
+    digest = hashlib.sha256()
+    for file_name in file_names:
+        with open(os.path.join(SRC_DIR, file_name), "rb") as file:
+            digest.update(file_name.encode())
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def hash_participant_data(participant_data, files_hash, params=None):
+    import pandas as pd
+
+    digest = hashlib.sha256(files_hash.encode())
+    report_params = {key: value for key, value in (params or {}).items() if key not in MANIFEST_IGNORED_PARAMS}
+    digest.update(json.dumps(report_params, sort_keys=True).encode())
+
+    for name in sorted(participant_data):
+        data = participant_data[name]
+        digest.update(name.encode())
+        columns = list(data.columns) if isinstance(data, pd.DataFrame) else [data.name]
+        digest.update(json.dumps([str(col) for col in columns]).encode())
+        digest.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def load_manifest(manifest_file=MANIFEST_FILE):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as file:
+        return json.load(file)
+
+def save_manifest(manifest, manifest_file=MANIFEST_FILE):
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    temp_file = f"{manifest_file}.tmp"
+    with open(temp_file, "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(temp_file, manifest_file)
+
+def render_reports(pids, workers=None, output_dir=OUTPUT_DIR, params=None, cohort_data=None, manifest_file=None, trace_dir=None, shared_assets=False, compress=None, metric_state_dir=None, on_result=None):
+    if workers is None:
+        workers = os.cpu_count()
+
+    split_data = {}
+    if cohort_data is not None:
+        from utils import split_cohort_data
+
+        split_data = split_cohort_data(cohort_data, pids)
+
+    # incremental builds skip participants whose data, template and settings hash to the same value as last time
+    manifest = {}
+    input_hashes = {}
+    if manifest_file is not None:
+        if cohort_data is None:
+            raise ValueError("Incremental builds need the cohort data to hash each participant's inputs")
+        if metric_state_dir is not None:
+            raise ValueError("Incremental builds do not track changes to interim metric state")
+
+        manifest = load_manifest(manifest_file)
+        files_hash = hash_files(MANIFEST_INPUT_FILES)
+        input_hashes = {str(pid): hash_participant_data(split_data[str(pid)], files_hash, params) for pid in pids}
+
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for pid in pids:
+            output_exists = os.path.exists(os.path.join(output_dir, get_output_file(pid)))
+            if str(pid) in input_hashes and output_exists and manifest.get(str(pid)) == input_hashes[str(pid)]:
+                log(f"Skipping participant {pid}: inputs unchanged since the last render")
+                continue
+
+            participant_data = split_data.get(str(pid))
+
+            report_params = dict(params or {})
+            if metric_state_dir is not None:
+                report_params["metric_state"] = os.path.abspath(os.path.join(metric_state_dir, f"{pid}.json"))
+
+            future = executor.submit(
+                render_report, pid, output_dir, report_params, participant_data,
+                trace_dir=trace_dir, shared_assets=shared_assets, compress=compress
+            )
+            futures[future] = pid
+
+        for future in as_completed(futures):
+            pid = futures[future]
+            try:
+                output_path = future.result()
+                log(f"Rendered final study report for participant {pid} to {output_path}")
+
+                if manifest_file is not None:
+                    manifest[str(pid)] = input_hashes[str(pid)]
+                    save_manifest(manifest, manifest_file)
+            except subprocess.CalledProcessError as err:
+                failures[pid] = err.stderr
+                log(f"Failed to render final study report for participant {pid}")
+            except Exception as err:
+                failures[pid] = str(err)
+                log(f"Failed to render final study report for participant {pid}")
+
+            # called as each report finishes, with the error or None, so callers can record progress as it happens
+            if on_result is not None:
+                on_result(pid, failures.get(pid))
+
+    return failures
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pids", nargs="+")
+    parser.add_argument("--workers", type=int, default=None, help="number of parallel renders (default: all cores)")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--bulk", action="store_true", help="extract all participants' data with one set of queries before rendering")
+    parser.add_argument("--incremental", action="store_true", help="only re-render participants whose inputs changed since the last run (implies --bulk)")
+    parser.add_argument("--manifest", default=MANIFEST_FILE)
+    parser.add_argument("--group", default="balance")
+    parser.add_argument("--snapshot", default=None, help="read from a local snapshot instead of the study database")
+    parser.add_argument("--value-boxes", choices=["plot", "html"], default="plot", help="render value boxes as plotnine figures or inline html")
+    parser.add_argument("--tables", choices=["gt", "html", "virtual"], default="gt", help="render data tables with great_tables, the lightweight html renderer, or as virtualized tables that only draw the rows in view")
+    parser.add_argument("--fitbit-source", choices=["daily", "intraday"], default="daily", help="take steps, sleep and wear time from the daily fitbit summaries or aggregate them from intraday records")
+    parser.add_argument("--shared-assets", action="store_true", help="link every report to one content-hashed copy of the theme, scripts and fonts under output/assets instead of embedding them")
+    parser.add_argument("--compress", nargs="+", choices=COMPRESSION_FORMATS, default=None, help="also write precompressed copies of reports and shared assets")
+    parser.add_argument("--metric-state-dir", default=None, help="take value boxes from the running metric state written by update_metric_state.py (interim reports)")
+    parser.add_argument("--trace", action="store_true", help="write per-stage timings for every report and a cohort hotspot summary")
+    parser.add_argument("--trace-dir", default=TRACE_DIR)
+    args = parser.parse_args()
+
+    params = {"value_boxes": args.value_boxes, "tables": args.tables, "fitbit_source": args.fitbit_source}
+    if args.snapshot:
+        params["snapshot"] = os.path.abspath(args.snapshot)
+
+    cohort_data = None
+    if args.bulk or args.incremental:
+        from utils import load_credentials, connect_to_database, connect_to_snapshot, extract_cohort_data
+
+        log(f"Extracting data for {len(args.pids)} participants")
+        if args.snapshot:
+            con = connect_to_snapshot(args.snapshot)
+        else:
+            credentials = load_credentials(args.group, CREDENTIALS_FILE)
+            con = connect_to_database(credentials)
+        cohort_data = extract_cohort_data(con, pids=args.pids, fitbit_source=args.fitbit_source)
+        con.close()
+
+    # encode cached fonts once up front rather than racing to do it in every worker
+    from assets import build_assets
+    build_assets()
+
+    log(f"Rendering final study reports for {len(args.pids)} participants")
+    failures = render_reports(
+        args.pids,
+        workers=args.workers,
+        output_dir=args.output_dir,
+        params=params,
+        cohort_data=cohort_data,
+        manifest_file=args.manifest if args.incremental else None,
+        trace_dir=args.trace_dir if args.trace else None,
+        shared_assets=args.shared_assets,
+        compress=args.compress,
+        metric_state_dir=args.metric_state_dir
+    )
+
+    if args.trace:
+        rendered_pids = [str(pid) for pid in args.pids if pid not in failures]
+        hotspots = save_hotspots(args.trace_dir, rendered_pids)
+        log(f"Wrote stage traces and hotspot summary to {args.trace_dir}")
+        for hotspot in hotspots[:5]:
+            log(f"  {hotspot['stage']}: {hotspot['total_seconds']:.2f}s total, {hotspot['mean_seconds']:.2f}s mean, slowest for {hotspot['slowest_pid']}")
+
+    for pid, err in failures.items():
+        print(f"{pid}: {err}", file=sys.stderr)
+
+    log("All done!" if not failures else f"Done with {len(failures)} failures")
+    sys.exit(1 if failures else 0)
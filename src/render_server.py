@@ -0,0 +1,128 @@
+import os
+import socket
+import socketserver
+import subprocess
+import tempfile
+
+from render_reports import CREDENTIALS_FILE, OUTPUT_DIR, log, render_report
+
+SOCKET_FILE = os.path.join(tempfile.gettempdir(), "balance_render_server.sock")
+
+# seconds Quarto keeps the Jupyter kernel alive between renders
+KERNEL_KEEP_ALIVE = 3600
+
+class RenderHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode().split()
+            if not command:
+                continue
+
+            if command[0] == "render" and len(command) == 2:
+                response = self.server.render(command[1])
+            elif command[0] == "shutdown":
+                self.wfile.write(b"ok shutting down\n")
+                self.server.shutdown_requested = True
+                return
+            else:
+                response = f"error unknown command: {' '.join(command)}"
+
+            self.wfile.write(f"{response}\n".encode())
+
+class RenderServer(socketserver.UnixStreamServer):
+    # jobs are handled one after another by a single warm process:
+    # the data layer, its imports and its connection pool live here, and Quarto reuses one daemonized kernel
+    def __init__(self, socket_file, output_dir=OUTPUT_DIR, group="balance", snapshot=None):
+        import utils
+
+        self.utils = utils
+        self.output_dir = output_dir
+        self.render_dir = tempfile.mkdtemp(prefix="balance_render_server_")
+        self.shutdown_requested = False
+
+        if snapshot:
+            con = utils.connect_to_snapshot(snapshot)
+        else:
+            credentials = utils.load_credentials(group, CREDENTIALS_FILE)
+            con = utils.connect_to_database(credentials)
+
+        # the activity dictionary is loaded once and shared by every job
+        self.activity_names = utils.load_activity_names(con)
+
+        # keep the pooled engine and hand the connection back to it
+        self.engine = con.engine
+        con.close()
+
+        super().__init__(socket_file, RenderHandler)
+
+    def render(self, pid):
+        try:
+            with self.engine.connect() as con:
+                participant_data = self.utils.extract_cohort_data(con, pids=[pid], activity_names=self.activity_names)
+
+            output_path = render_report(
+                pid,
+                output_dir=self.output_dir,
+                participant_data=participant_data,
+                render_dir=self.render_dir,
+                quarto_args=["--execute-daemon", str(KERNEL_KEEP_ALIVE)]
+            )
+            log(f"Rendered final study report for participant {pid} to {output_path}")
+            return f"ok {output_path}"
+        except subprocess.CalledProcessError as err:
+            log(f"Failed to render final study report for participant {pid}")
+            return f"error {err.stderr.strip().splitlines()[-1] if err.stderr.strip() else err}"
+        except Exception as err:
+            log(f"Failed to render final study report for participant {pid}")
+            return f"error {err}"
+
+    def serve(self):
+        log(f"Render server listening on {self.server_address}")
+        while not self.shutdown_requested:
+            self.handle_request()
+        self.server_close()
+        os.remove(self.server_address)
+
+def send_commands(commands, socket_file=SOCKET_FILE):
+    responses = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_file)
+        stream = client.makefile("rw")
+        for command in commands:
+            stream.write(f"{command}\n")
+            stream.flush()
+            responses.append(stream.readline().strip())
+    return responses
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default=SOCKET_FILE)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="start the render server")
+    serve_parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    serve_parser.add_argument("--group", default="balance")
+    serve_parser.add_argument("--snapshot", default=None, help="read from a local snapshot instead of the study database")
+
+    render_parser = subparsers.add_parser("render", help="queue participant reports on a running server")
+    render_parser.add_argument("pids", nargs="+")
+
+    subparsers.add_parser("shutdown", help="stop a running server")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        snapshot = os.path.abspath(args.snapshot) if args.snapshot else None
+        RenderServer(args.socket, output_dir=args.output_dir, group=args.group, snapshot=snapshot).serve()
+    elif args.command == "render":
+        responses = send_commands([f"render {pid}" for pid in args.pids], args.socket)
+        for pid, response in zip(args.pids, responses):
+            print(f"{pid}: {response}")
+        sys.exit(0 if all(response.startswith("ok") for response in responses) else 1)
+    else:
+        print(send_commands(["shutdown"], args.socket)[0])
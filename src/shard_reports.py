@@ -0,0 +1,397 @@
+import heapq
+import json
+import os
+import shutil
+import socket
+import sys
+import time
+
+from collections import Counter
+from datetime import datetime
+
+from render_reports import CREDENTIALS_FILE, OUTPUT_DIR, load_manifest, log, render_reports, save_hotspots, save_manifest
+from shared_assets import COMPRESSION_FORMATS, SHARED_ASSETS_DIR
+
+# the work manifest, shard locks, per-participant status and each shard's output live here, on storage every node can reach
+WORK_DIR = os.path.join(OUTPUT_DIR, "shards")
+WORK_MANIFEST_FILE = "manifest.json"
+PARTITIONS = ["count", "cost"]
+
+# every render pays the same Quarto and kernel start-up, counted here in survey responses
+BASE_RENDER_COST = 200
+
+# a claim whose lockfile has not been touched for this many seconds belongs to a node that stopped;
+# it must be longer than the slowest single render, since the lock is touched as each report finishes
+LOCK_TIMEOUT = 3600
+
+PARTICIPANTS_QUERY = '''
+    select phases.pId, coalesce(responses.n_responses, 0) as n_responses
+    from (select distinct pId from user_study_phases) as phases
+    left join (
+        select pId, count(*) as n_responses
+        from survey_responses
+        group by pId
+    ) as responses on phases.pId = responses.pId
+    order by phases.pId;
+'''
+
+def get_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def now():
+    return datetime.now().isoformat(timespec="seconds")
+
+def get_manifest_file(work_dir):
+    return os.path.join(work_dir, WORK_MANIFEST_FILE)
+
+def get_lock_file(work_dir, shard_id):
+    return os.path.join(work_dir, "locks", f"{shard_id}.lock")
+
+def get_status_file(work_dir, shard_id):
+    return os.path.join(work_dir, "status", f"{shard_id}.json")
+
+def get_shard_output_dir(work_dir, shard_id):
+    return os.path.join(work_dir, shard_id)
+
+def connect(snapshot=None, group="balance"):
+    from utils import connect_to_database, connect_to_snapshot, load_credentials
+
+    if snapshot:
+        return connect_to_snapshot(snapshot)
+    return connect_to_database(load_credentials(group, CREDENTIALS_FILE))
+
+def get_participants(con, pids=None):
+    import pandas as pd
+
+    from utils import text
+
+    participants = pd.read_sql(sql=text(PARTICIPANTS_QUERY), con=con)
+    participants["pId"] = participants["pId"].astype(str)
+    if pids is not None:
+        participants = participants[participants["pId"].isin([str(pid) for pid in pids])]
+
+    # render time grows with the number of survey days on top of a fixed per-report cost
+    participants["cost"] = participants["n_responses"].astype(int) + BASE_RENDER_COST
+    return participants.reset_index(drop=True)
+
+def partition_participants(participants, n_shards, partition="count"):
+    from utils import chunk_list
+
+    pids = participants["pId"].tolist()
+    costs = dict(zip(pids, participants["cost"].tolist()))
+    n_shards = max(1, min(n_shards, len(pids)))
+
+    if partition == "count":
+        groups = chunk_list(pids, n_shards)
+    elif partition == "cost":
+        # most expensive participants first, each to the shard with the lowest estimated cost so far
+        groups = [[] for _ in range(n_shards)]
+        totals = [(0, i) for i in range(n_shards)]
+        for pid in sorted(pids, key=lambda pid: costs[pid], reverse=True):
+            total, i = heapq.heappop(totals)
+            groups[i].append(pid)
+            heapq.heappush(totals, (total + costs[pid], i))
+    else:
+        raise ValueError(f"`partition` must be one of: {', '.join(PARTITIONS)}")
+
+    return [
+        {"id": f"shard-{i:03d}", "pids": group, "estimated_cost": int(sum(costs[pid] for pid in group))}
+        for i, group in enumerate(groups)
+    ]
+
+def plan_shards(con, n_shards, partition="count", pids=None, params=None, options=None, work_dir=WORK_DIR, force=False):
+    manifest_file = get_manifest_file(work_dir)
+    if os.path.exists(manifest_file) and not force:
+        raise ValueError(f"{manifest_file} already exists; resume it with `work` or replace it with --force")
+    if force and os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
+
+    participants = get_participants(con, pids)
+    manifest = {
+        "created_at": now(),
+        "partition": partition,
+        "params": params or {},
+        "options": options or {},
+        "shards": partition_participants(participants, n_shards, partition)
+    }
+    save_manifest(manifest, manifest_file)
+    return manifest
+
+def load_shard_status(work_dir, shard):
+    status = load_manifest(get_status_file(work_dir, shard["id"]))
+    return {pid: status.get(pid, {"status": "pending"}) for pid in shard["pids"]}
+
+def get_pending_pids(status, retry_failed=False, attempted=()):
+    # participants already attempted by this node's run are not retried again, so a render that always fails ends the run
+    retry = ["pending", "failed"] if retry_failed else ["pending"]
+    return [pid for pid, pid_status in status.items() if pid_status["status"] in retry and pid not in attempted]
+
+def break_stale_lock(lock_file, lock_timeout=LOCK_TIMEOUT):
+    try:
+        if time.time() - os.path.getmtime(lock_file) <= lock_timeout:
+            return
+        # renaming is atomic, so when several nodes find the same stale lock only one of them takes it away
+        stale_file = f"{lock_file}.{get_node_id()}.stale"
+        os.rename(lock_file, stale_file)
+    except FileNotFoundError:
+        return
+
+    # another node may have broken and re-claimed the lock between the check and the rename
+    if time.time() - os.path.getmtime(stale_file) <= lock_timeout:
+        os.rename(stale_file, lock_file)
+    else:
+        os.remove(stale_file)
+
+def claim_shard(work_dir, manifest, node, lock_timeout=LOCK_TIMEOUT, retry_failed=False, attempted=()):
+    os.makedirs(os.path.join(work_dir, "locks"), exist_ok=True)
+
+    for shard in manifest["shards"]:
+        if not get_pending_pids(load_shard_status(work_dir, shard), retry_failed, attempted):
+            continue
+
+        lock_file = get_lock_file(work_dir, shard["id"])
+        break_stale_lock(lock_file, lock_timeout)
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        with os.fdopen(fd, "w") as file:
+            json.dump({"node": node, "claimed_at": now()}, file)
+
+        # the shard may have been finished by another node since the status was read above
+        if get_pending_pids(load_shard_status(work_dir, shard), retry_failed, attempted):
+            return shard
+        release_shard(work_dir, shard["id"])
+    return None
+
+def read_claim(work_dir, shard_id):
+    # a lock that is being written or was just released reads as unclaimed
+    try:
+        with open(get_lock_file(work_dir, shard_id)) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def release_shard(work_dir, shard_id):
+    try:
+        os.remove(get_lock_file(work_dir, shard_id))
+    except FileNotFoundError:
+        pass
+
+def render_shard(work_dir, manifest, shard, node, workers=None, retry_failed=False, attempted=None):
+    params = manifest["params"]
+    options = manifest["options"]
+    status_file = get_status_file(work_dir, shard["id"])
+    lock_file = get_lock_file(work_dir, shard["id"])
+    output_dir = get_shard_output_dir(work_dir, shard["id"])
+
+    status = load_shard_status(work_dir, shard)
+    pids = get_pending_pids(status, retry_failed, attempted or ())
+    if attempted is not None:
+        attempted.update(pids)
+
+    cohort_data = None
+    if options.get("bulk"):
+        from utils import extract_cohort_data
+
+        log(f"Extracting data for {len(pids)} participants in {shard['id']}")
+        con = connect(params.get("snapshot"), options.get("group", "balance"))
+        cohort_data = extract_cohort_data(con, pids=pids, fitbit_source=params.get("fitbit_source", "daily"))
+        con.close()
+
+    def record_result(pid, error):
+        # saved after every report, so a node that stops part way through only loses the renders in flight
+        status[str(pid)] = {"status": "failed" if error else "rendered", "node": node, "updated_at": now(), "error": error}
+        save_manifest(status, status_file)
+        os.utime(lock_file)
+
+    return render_reports(
+        pids,
+        workers=workers,
+        output_dir=output_dir,
+        params=params,
+        cohort_data=cohort_data,
+        trace_dir=os.path.join(output_dir, "traces") if options.get("trace") else None,
+        shared_assets=options.get("shared_assets", False),
+        compress=options.get("compress"),
+        on_result=record_result
+    )
+
+def work(work_dir=WORK_DIR, node=None, workers=None, lock_timeout=LOCK_TIMEOUT, retry_failed=False):
+    # claims and renders one shard after another until every shard is finished or held by another node
+    node = node or get_node_id()
+    manifest = load_manifest(get_manifest_file(work_dir))
+    if not manifest:
+        raise ValueError(f"No work manifest in {work_dir}; create one with `plan` first")
+
+    failures = {}
+    attempted = set()
+    while True:
+        shard = claim_shard(work_dir, manifest, node, lock_timeout, retry_failed, attempted)
+        if shard is None:
+            break
+
+        log(f"Node {node} claimed {shard['id']} ({len(shard['pids'])} participants)")
+        try:
+            failures.update(render_shard(work_dir, manifest, shard, node, workers, retry_failed, attempted))
+        finally:
+            release_shard(work_dir, shard["id"])
+        log(f"Node {node} finished {shard['id']}")
+
+    return failures
+
+def _work_node(*args):
+    sys.exit(1 if work(*args) else 0)
+
+def work_locally(n_nodes, work_dir=WORK_DIR, workers=None, lock_timeout=LOCK_TIMEOUT, retry_failed=False):
+    # runs `n_nodes` independent workers on this machine, claiming shards exactly as separate hosts would
+    import multiprocessing
+
+    if workers is None:
+        workers = max(1, os.cpu_count() // n_nodes)
+
+    node = get_node_id()
+    processes = [
+        multiprocessing.Process(target=_work_node, args=(work_dir, f"{node}-{i}", workers, lock_timeout, retry_failed))
+        for i in range(n_nodes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return [process.exitcode for process in processes]
+
+def summarize_shards(work_dir=WORK_DIR):
+    manifest = load_manifest(get_manifest_file(work_dir))
+
+    summary = []
+    for shard in manifest.get("shards", []):
+        counts = Counter(pid_status["status"] for pid_status in load_shard_status(work_dir, shard).values())
+        claim = read_claim(work_dir, shard["id"])
+        summary.append({
+            "shard": shard["id"],
+            "n_pids": len(shard["pids"]),
+            "estimated_cost": shard["estimated_cost"],
+            "rendered": counts["rendered"],
+            "failed": counts["failed"],
+            "pending": counts["pending"],
+            "claimed_by": claim.get("node")
+        })
+    return summary
+
+def merge_dir(source_dir, target_dir, overwrite=True):
+    for root, _, file_names in os.walk(source_dir):
+        target_root = os.path.join(target_dir, os.path.relpath(root, source_dir))
+        os.makedirs(target_root, exist_ok=True)
+        for file_name in file_names:
+            target_file = os.path.join(target_root, file_name)
+            if overwrite or not os.path.exists(target_file):
+                shutil.move(os.path.join(root, file_name), target_file)
+    shutil.rmtree(source_dir)
+
+def merge_shards(work_dir=WORK_DIR, output_dir=OUTPUT_DIR):
+    manifest = load_manifest(get_manifest_file(work_dir))
+    os.makedirs(output_dir, exist_ok=True)
+
+    for shard in manifest.get("shards", []):
+        shard_dir = get_shard_output_dir(work_dir, shard["id"])
+        if not os.path.isdir(shard_dir):
+            continue
+
+        for file_name in sorted(os.listdir(shard_dir)):
+            source = os.path.join(shard_dir, file_name)
+            if os.path.isdir(source):
+                # shared assets are content-hashed, so a name already in the output tree holds the same bytes
+                merge_dir(source, os.path.join(output_dir, file_name), overwrite=file_name != SHARED_ASSETS_DIR)
+            else:
+                shutil.move(source, os.path.join(output_dir, file_name))
+
+    trace_dir = os.path.join(output_dir, "traces")
+    if manifest.get("options", {}).get("trace") and os.path.isdir(trace_dir):
+        save_hotspots(trace_dir)
+
+    return summarize_shards(work_dir)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--work-dir", default=WORK_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = commands.add_parser("plan", help="list participants from user_study_phases and split them into shards")
+    plan_parser.add_argument("--pids", nargs="+", default=None, help="only shard these participants")
+    plan_parser.add_argument("--shards", type=int, required=True)
+    plan_parser.add_argument("--partition", choices=PARTITIONS, default="count", help="balance shards by number of participants or by estimated render cost")
+    plan_parser.add_argument("--force", action="store_true", help="replace an existing manifest, discarding its status and shard outputs")
+    plan_parser.add_argument("--group", default="balance")
+    plan_parser.add_argument("--snapshot", default=None, help="read from a local snapshot instead of the study database")
+    plan_parser.add_argument("--bulk", action="store_true", help="extract each shard's data with one set of queries before rendering it")
+    plan_parser.add_argument("--value-boxes", choices=["plot", "html"], default="plot")
+    plan_parser.add_argument("--tables", choices=["gt", "html", "virtual"], default="gt")
+    plan_parser.add_argument("--fitbit-source", choices=["daily", "intraday"], default="daily")
+    plan_parser.add_argument("--shared-assets", action="store_true")
+    plan_parser.add_argument("--compress", nargs="+", choices=COMPRESSION_FORMATS, default=None)
+    plan_parser.add_argument("--trace", action="store_true")
+
+    work_parser = commands.add_parser("work", help="claim and render shards until none are left")
+    work_parser.add_argument("--node", default=None, help="name recorded in locks and status (default: host and process id)")
+    work_parser.add_argument("--workers", type=int, default=None, help="parallel renders on this node (default: all cores)")
+    work_parser.add_argument("--local-nodes", type=int, default=None, help="run this many nodes as separate processes on this machine")
+    work_parser.add_argument("--lock-timeout", type=int, default=LOCK_TIMEOUT, help="seconds after which an untouched claim is taken over")
+    work_parser.add_argument("--retry-failed", action="store_true", help="also re-render participants whose last render failed")
+
+    commands.add_parser("status", help="show progress for every shard")
+
+    release_parser = commands.add_parser("release", help="drop the claim on shards whose node is known to have stopped")
+    release_parser.add_argument("shards", nargs="+")
+
+    merge_parser = commands.add_parser("merge", help="move every shard's reports, assets and traces into one output tree")
+    merge_parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        params = {"value_boxes": args.value_boxes, "tables": args.tables, "fitbit_source": args.fitbit_source}
+        if args.snapshot:
+            params["snapshot"] = os.path.abspath(args.snapshot)
+        options = {"bulk": args.bulk, "group": args.group, "shared_assets": args.shared_assets, "compress": args.compress, "trace": args.trace}
+
+        con = connect(params.get("snapshot"), args.group)
+        manifest = plan_shards(con, args.shards, args.partition, args.pids, params, options, args.work_dir, args.force)
+        con.close()
+
+        for shard in manifest["shards"]:
+            log(f"{shard['id']}: {len(shard['pids'])} participants, estimated cost {shard['estimated_cost']}")
+
+    elif args.command == "work":
+        # encode cached fonts once up front rather than racing to do it in every worker
+        from assets import build_assets
+        build_assets()
+
+        if args.local_nodes:
+            exit_codes = work_locally(args.local_nodes, args.work_dir, args.workers, args.lock_timeout, args.retry_failed)
+            failed = any(exit_code != 0 for exit_code in exit_codes)
+        else:
+            failures = work(args.work_dir, args.node, args.workers, args.lock_timeout, args.retry_failed)
+            for pid, err in failures.items():
+                print(f"{pid}: {err}", file=sys.stderr)
+            failed = bool(failures)
+
+        log("All done!" if not failed else "Done with failures; see `status` and rerun with --retry-failed")
+        sys.exit(1 if failed else 0)
+
+    elif args.command == "release":
+        for shard_id in args.shards:
+            release_shard(args.work_dir, shard_id)
+            log(f"Released {shard_id}")
+
+    else:
+        summary = merge_shards(args.work_dir, args.output_dir) if args.command == "merge" else summarize_shards(args.work_dir)
+        for shard in summary:
+            claim = f", claimed by {shard['claimed_by']}" if shard["claimed_by"] else ""
+            log(f"{shard['shard']}: {shard['rendered']} rendered, {shard['failed']} failed, {shard['pending']} pending{claim}")
+
+        unfinished = sum(shard["failed"] + shard["pending"] for shard in summary)
+        if args.command == "merge":
+            log(f"Merged shard outputs into {args.output_dir}" + (f"; {unfinished} participants are not rendered yet" if unfinished else ""))
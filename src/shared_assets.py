@@ -0,0 +1,122 @@
+import base64
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import shutil
+
+SHARED_ASSETS_DIR = "assets"
+COMPRESSION_FORMATS = ["gzip", "brotli"]
+
+# quarto args that keep theme css, bootstrap and other libraries as separate files instead of embedding them
+SHARED_ASSETS_QUARTO_ARGS = ["-M", "embed-resources:false", "-M", "self-contained:false"]
+
+# large inline style blocks (the embedded theme font) are identical across reports and move to the shared bundle too
+SHARED_STYLE_MIN_BYTES = 4096
+
+# formats that are already compressed gain nothing from precompression
+COMPRESSED_EXTENSIONS = [".woff", ".woff2", ".png", ".jpg", ".jpeg", ".gif"]
+
+LIB_REF_PATTERN = re.compile(r'(src|href)="([^"]+_files/libs/[^"?#]+)[^"]*"')
+FIGURE_REF_PATTERN = re.compile(r'src="([^"]+_files/figure-html/[^"]+)"')
+STYLE_PATTERN = re.compile(r"<style[^>]*>(.*?)</style>", re.DOTALL)
+CSS_URL_PATTERN = re.compile(r"url\(['\"]?(?!data:|https?:|/|#)([^'\")?#]+)([^'\")]*)['\"]?\)")
+
+def get_hashed_name(file_name, content):
+    stem, ext = os.path.splitext(os.path.basename(file_name))
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+def write_asset(content, hashed_name, assets_dir, compress=None):
+    # names are content hashes, so an existing file never needs rewriting and concurrent renders can race safely
+    asset_file = os.path.join(assets_dir, hashed_name)
+    if os.path.exists(asset_file):
+        return
+
+    os.makedirs(assets_dir, exist_ok=True)
+    temp_file = f"{asset_file}.{os.getpid()}.tmp"
+    with open(temp_file, "wb") as file:
+        file.write(content)
+    os.replace(temp_file, asset_file)
+
+    if os.path.splitext(hashed_name)[1] not in COMPRESSED_EXTENSIONS:
+        precompress(asset_file, compress)
+
+def share_css(css_file, assets_dir, compress=None):
+    css_dir = os.path.dirname(css_file)
+    with open(css_file) as file:
+        css = file.read()
+
+    def share_url(match):
+        return f"url({share_file(os.path.join(css_dir, match.group(1)), assets_dir, compress)}{match.group(2)})"
+
+    # fonts and images referenced by the stylesheet are hashed first so its own hash changes with theirs
+    return CSS_URL_PATTERN.sub(share_url, css).encode()
+
+def share_file(file_name, assets_dir, compress=None):
+    if file_name.endswith(".css"):
+        content = share_css(file_name, assets_dir, compress)
+    else:
+        with open(file_name, "rb") as file:
+            content = file.read()
+
+    hashed_name = get_hashed_name(file_name, content)
+    write_asset(content, hashed_name, assets_dir, compress)
+    return hashed_name
+
+def inline_figure(file_name):
+    mime_type = mimetypes.guess_type(file_name)[0] or "image/png"
+    with open(file_name, "rb") as file:
+        encoded = base64.b64encode(file.read()).decode()
+    return f"data:{mime_type};base64,{encoded}"
+
+def share_report_assets(html_file, output_dir, compress=None):
+    # rewrites a report rendered without embedded resources so it links to one shared, content-hashed copy of
+    # each library under `output_dir/assets` and keeps only its own figures inline
+    html_dir = os.path.dirname(html_file)
+    assets_dir = os.path.join(output_dir, SHARED_ASSETS_DIR)
+
+    with open(html_file) as file:
+        report = file.read()
+
+    def share_lib(match):
+        hashed_name = share_file(os.path.join(html_dir, match.group(2)), assets_dir, compress)
+        return f'{match.group(1)}="{SHARED_ASSETS_DIR}/{hashed_name}"'
+
+    def share_style(match):
+        css = match.group(1).encode()
+        if len(css) < SHARED_STYLE_MIN_BYTES or b"@font-face" not in css:
+            return match.group(0)
+        hashed_name = get_hashed_name("style.css", css)
+        write_asset(css, hashed_name, assets_dir, compress)
+        return f'<link href="{SHARED_ASSETS_DIR}/{hashed_name}" rel="stylesheet">'
+
+    report = LIB_REF_PATTERN.sub(share_lib, report)
+    report = FIGURE_REF_PATTERN.sub(lambda match: f'src="{inline_figure(os.path.join(html_dir, match.group(1)))}"', report)
+    report = STYLE_PATTERN.sub(share_style, report)
+
+    with open(html_file, "w") as file:
+        file.write(report)
+
+    files_dir = os.path.splitext(html_file)[0] + "_files"
+    if os.path.isdir(files_dir):
+        shutil.rmtree(files_dir)
+
+def precompress(file_name, formats=None):
+    for compression in formats or []:
+        with open(file_name, "rb") as file:
+            content = file.read()
+
+        if compression == "gzip":
+            compressed, suffix = gzip.compress(content, compresslevel=9, mtime=0), ".gz"
+        elif compression == "brotli":
+            import brotli
+
+            compressed, suffix = brotli.compress(content), ".br"
+        else:
+            raise ValueError(f"`compression` must be one of: {', '.join(COMPRESSION_FORMATS)}")
+
+        temp_file = f"{file_name}{suffix}.{os.getpid()}.tmp"
+        with open(temp_file, "wb") as file:
+            file.write(compressed)
+        os.replace(temp_file, file_name + suffix)
@@ -0,0 +1,142 @@
+import os
+
+import duckdb
+import pandas as pd
+
+from datetime import timedelta
+from sqlalchemy import inspect, text
+
+from utils import connect_for_streaming
+
+SNAPSHOT_FILE = "../snapshot/balance.duckdb"
+CHUNK_SIZE = 100000
+
+# days before the watermark that are deleted and re-fetched on every refresh, so fitbit data that syncs late
+# and surveys submitted late for earlier days still reach the snapshot
+LOOKBACK_DAYS = 7
+
+# small lookup tables are copied in full on every refresh
+FULL_TABLES = ["user_activities", "activities", "user_activity_preferences", "user_study_phases"]
+
+# large tables are refreshed from a watermark on their date column; the last snapshotted day is re-fetched since it may
+# have been partial, along with the `LOOKBACK_DAYS` before it
+DATED_TABLES = {"survey_responses": "date", "fitbit_data": "date", "fitbit_intraday_data": "dateTime"}
+
+# tables that not every study database has, mirrored only when the source has them
+OPTIONAL_TABLES = ["fitbit_intraday_data"]
+
+def open_snapshot(file_name=SNAPSHOT_FILE):
+    os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+    return duckdb.connect(file_name)
+
+def table_exists(snapshot, table):
+    count = snapshot.execute(
+        "select count(*) from information_schema.tables where table_name = ?", [table]
+    ).fetchone()[0]
+    return count > 0
+
+def get_watermark(snapshot, table, lookback_days=LOOKBACK_DAYS, date_col="date"):
+    if not table_exists(snapshot, table):
+        return None
+    watermark = snapshot.execute(f"select max({date_col}) from {table}").fetchone()[0]
+    if watermark is None:
+        return None
+    return watermark - timedelta(days=lookback_days)
+
+def append_rows(snapshot, table, data):
+    snapshot.register("new_rows", data)
+    if table_exists(snapshot, table):
+        snapshot.execute(f"insert into {table} by name select * from new_rows")
+    else:
+        snapshot.execute(f"create table {table} as select * from new_rows")
+    snapshot.unregister("new_rows")
+
+def copy_rows(con, snapshot, table, query, params=None):
+    n_rows = 0
+    with connect_for_streaming(con) as stream_con:
+        for data in pd.read_sql(sql=text(query), con=stream_con, params=params, chunksize=CHUNK_SIZE):
+            append_rows(snapshot, table, data)
+            n_rows += data.shape[0]
+    return n_rows
+
+def refresh_full_table(con, snapshot, table):
+    snapshot.execute(f"drop table if exists {table}")
+    return copy_rows(con, snapshot, table, f"select * from {table}")
+
+def refresh_dated_table(con, snapshot, table, watermark, date_col="date"):
+    if watermark is None:
+        return copy_rows(con, snapshot, table, f"select * from {table}")
+
+    snapshot.execute(f"delete from {table} where {date_col} >= ?", [watermark])
+    return copy_rows(
+        con, snapshot, table, f"select * from {table} where {date_col} >= :watermark", {"watermark": watermark}
+    )
+
+def refresh_survey_response_details(con, snapshot, watermark):
+    # details carry no date of their own, so they follow the watermark of the surveys they belong to
+    TABLE = "survey_response_details"
+
+    if watermark is None or not table_exists(snapshot, TABLE):
+        snapshot.execute(f"drop table if exists {TABLE}")
+        return copy_rows(con, snapshot, TABLE, f"select * from {TABLE}")
+
+    snapshot.execute(
+        f"delete from {TABLE} where surveyId in (select surveyId from survey_responses where date >= ?)", [watermark]
+    )
+    query = f'''
+    select {TABLE}.*
+    from {TABLE}
+    inner join survey_responses on survey_responses.surveyId = {TABLE}.surveyId
+    where survey_responses.date >= :watermark
+    '''
+    return copy_rows(con, snapshot, TABLE, query, {"watermark": watermark})
+
+def refresh_snapshot(con, file_name=SNAPSHOT_FILE, lookback_days=LOOKBACK_DAYS):
+    snapshot = open_snapshot(file_name)
+    n_rows = {}
+
+    try:
+        snapshot.begin()
+
+        for table in FULL_TABLES:
+            n_rows[table] = refresh_full_table(con, snapshot, table)
+
+        # details must be refreshed before survey_responses moves its watermark
+        survey_watermark = get_watermark(snapshot, "survey_responses", lookback_days)
+        n_rows["survey_response_details"] = refresh_survey_response_details(con, snapshot, survey_watermark)
+
+        for table, date_col in DATED_TABLES.items():
+            if table in OPTIONAL_TABLES and not inspect(con).has_table(table):
+                continue
+            watermark = get_watermark(snapshot, table, lookback_days, date_col)
+            n_rows[table] = refresh_dated_table(con, snapshot, table, watermark, date_col)
+
+        snapshot.commit()
+    except Exception:
+        snapshot.rollback()
+        raise
+    finally:
+        snapshot.close()
+
+    return n_rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from utils import load_credentials, connect_to_database
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--snapshot", default=SNAPSHOT_FILE)
+    parser.add_argument("--group", default="balance")
+    parser.add_argument("--lookback-days", type=int, default=LOOKBACK_DAYS, help="days before the latest snapshotted date to re-fetch")
+    args = parser.parse_args()
+
+    credentials = load_credentials(args.group)
+    con = connect_to_database(credentials)
+
+    n_rows = refresh_snapshot(con, args.snapshot, args.lookback_days)
+    con.close()
+
+    for table, n in n_rows.items():
+        print(f"{table}: {n} rows fetched")
@@ -0,0 +1,42 @@
+import os
+
+from datetime import date
+
+from utils import (
+    connect_to_database, connect_to_snapshot, get_metrics_from_state, load_credentials,
+    load_metric_state, refresh_metric_state, save_metric_state
+)
+
+STATE_DIR = "../output/metric_state"
+
+def get_state_file(pid, state_dir=STATE_DIR):
+    return os.path.join(state_dir, f"{pid}.json")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pids", nargs="+")
+    parser.add_argument("--state-dir", default=STATE_DIR)
+    parser.add_argument("--until", default=date.today().isoformat(), help="fold in days before this date (default: today, so partially completed days are picked up next time)")
+    parser.add_argument("--group", default="balance")
+    parser.add_argument("--snapshot", default=None, help="read from a local snapshot instead of the study database")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        con = connect_to_snapshot(os.path.abspath(args.snapshot))
+    else:
+        credentials = load_credentials(args.group)
+        con = connect_to_database(credentials)
+
+    for pid in args.pids:
+        state_file = get_state_file(pid, args.state_dir)
+        state = refresh_metric_state(con, load_metric_state(state_file, pid), until=args.until)
+        save_metric_state(state, state_file)
+
+        metrics = get_metrics_from_state(state)
+        print(f"{pid}: up to date through {state['last_date']}")
+        print(metrics.drop(columns="pId").to_string(index=False))
+
+    con.close()
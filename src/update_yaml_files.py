@@ -33,22 +33,20 @@ def write_file(file_name, settings, quoted_values):
     with open(file_name, "w") as outfile:
         yaml.dump(settings, outfile, default_flow_style=False, sort_keys=False, Dumper=QuotedDumper)
 
-def update_header(pid):
-    FILE_NAME = "_quarto.yml"
-
-    settings = open_file(FILE_NAME)
+def update_header(pid, file_name="_quarto.yml"):
+    settings = open_file(file_name)
     settings = update_settings(settings, pid)
     quoted_values = get_quoted_values(settings)
 
-    write_file(FILE_NAME, settings, quoted_values)
-
-def update_params(pid):
-    FILE_NAME = "params.yml"
+    write_file(file_name, settings, quoted_values)
 
-    params = open_file(FILE_NAME)
+def update_params(pid, file_name="params.yml", extra_params=None):
+    params = open_file(file_name)
     params["pid"] = pid
+    if extra_params is not None:
+        params.update(extra_params)
 
-    write_file(FILE_NAME, params, [pid])
+    write_file(file_name, params, [pid])
 
 
 if __name__ == "__main__":
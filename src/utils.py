@@ -1,30 +1,210 @@
+import base64
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import re
+import threading
+import time
 import pandas as pd 
 import numpy as np
-import plotnine as p9 
-import matplotlib
-import matplotlib.pyplot as plt  
+import psutil
 import warnings
 import yaml
 
-from sqlalchemy import create_engine
-from great_tables import *
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from html import escape as escape_html
+from sqlalchemy import bindparam, create_engine, text
 
-def load_credentials(group):
-    with open("../credentials.yaml") as file:
+# plotnine, matplotlib and great_tables are imported inside the functions that draw plots and tables,
+# so loading the data layer (and renders that use the html value boxes and tables) stays fast
+
+ASSETS_DIR = os.environ.get("BALANCE_ASSETS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets"))
+
+GOOGLE_FONT_OPTIONS = ["Inconsolata", "Source Code Pro", "Space Mono", "Fira Mono"]
+THEME_FONT = "Source Sans Pro"
+
+# value box plots fall back to the bundled theme font where the macOS fonts they ask for are not installed
+PLOT_FALLBACK_FONT = THEME_FONT
+
+def load_credentials(group, file_name="../credentials.yaml"):
+    with open(file_name) as file:
         credentials = yaml.safe_load(file)[group]
     return credentials
 
+# engines are kept per URL so long-lived processes reuse one connection pool
+_ENGINES = {}
+
+def get_engine(url, **kwargs):
+    if url not in _ENGINES:
+        _ENGINES[url] = create_engine(url, pool_pre_ping=True, **kwargs)
+    return _ENGINES[url]
+
 def connect_to_database(credentials):
     user = credentials["user"]
     password = credentials["password"]
     host = credentials["host"]
     name = credentials["database"]
 
-    engine = create_engine(f"mysql+mysqlconnector://{user}:{password}@{host}/{name}")
+    engine = get_engine(f"mysql+mysqlconnector://{user}:{password}@{host}/{name}")
     connection = engine.connect()
     return connection
 
+def connect_to_snapshot(file_name):
+    engine = get_engine(f"duckdb:///{file_name}", connect_args={"read_only": True})
+    connection = engine.connect()
+    return connection
+
+# mysql-connector always buffers the whole result set client-side, so large reads stream through pymysql's
+# server-side cursors instead
+STREAMING_DRIVERS = {"mysql": "pymysql"}
+
+@contextlib.contextmanager
+def connect_for_streaming(con):
+    # a separate connection whose results are fetched from the server as `pd.read_sql(chunksize=...)` consumes them
+    engine = con.engine
+    driver = STREAMING_DRIVERS.get(engine.dialect.name)
+    if driver is not None and engine.dialect.driver != driver:
+        engine = get_engine(engine.url.set(drivername=f"{engine.dialect.name}+{driver}"))
+    with engine.connect() as stream_con:
+        yield stream_con.execution_options(stream_results=True)
+
+QUERY_WORKERS = 4
+
+DAYS_OF_WEEK = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+# column types for each query's result, applied as it is read so cohort frames stay small in memory and in pickles;
+# "text" and "date" are arrow-backed when pyarrow is installed and left as python objects otherwise
+QUERY_SCHEMAS = {
+    "phase1": {
+        "Day of week": pd.CategoricalDtype(DAYS_OF_WEEK),
+        "Date": "date",
+        "Goodness rating": "Int8",
+        "Completed activities": "text",
+        "Note": "text",
+        "Steps": "Float32",
+        "Sleep": "Float32",
+        "has_fitbit": "Int8"
+    },
+    "phase1_extra": {
+        "n_activities": "Int32",
+        "n_distinct_activities": "Int16",
+        "avg_activity_score": "Float32"
+    },
+    "phase2": {
+        "Day of week": pd.CategoricalDtype(DAYS_OF_WEEK),
+        "Date": "date",
+        "Goodness rating": "Int8",
+        "Planned activities": "text",
+        "Completed activities": "text",
+        "Morning plan": "text",
+        "Evening note": "text",
+        "Steps": "Float32",
+        "Sleep": "Float32",
+        "has_morning": "Int8",
+        "has_evening": "Int8",
+        "n_planned_activities": "Int16",
+        "n_completed_activities": "Int16",
+        "has_fitbit": "Int8"
+    },
+    "phase2_extra": {
+        "activity_list": "text"
+    },
+    "phase1_activities": {
+        "activityId": "text",
+        "n_activities": "Int32",
+        "score_sum": "Float64",
+        "score_count": "Int32"
+    }
+}
+
+@functools.lru_cache(maxsize=None)
+def _get_arrow_dtypes():
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return {}
+    return {"text": pd.StringDtype("pyarrow"), "date": pd.ArrowDtype(pa.date32())}
+
+def apply_query_schema(data, name):
+    arrow_dtypes = _get_arrow_dtypes()
+    for col, dtype in QUERY_SCHEMAS.get(name, {}).items():
+        if col not in data.columns:
+            continue
+        if dtype in ["text", "date"]:
+            if dtype not in arrow_dtypes:
+                continue
+            values = data[col]
+            if dtype == "date" and pd.api.types.is_datetime64_any_dtype(values):
+                values = values.dt.date
+            data[col] = values.astype(arrow_dtypes[dtype])
+        elif isinstance(dtype, pd.CategoricalDtype):
+            data[col] = data[col].astype(dtype)
+        else:
+            # aggregates can come back as decimals or floats, so numbers go through to_numeric first
+            data[col] = pd.to_numeric(data[col], errors="coerce").astype(dtype)
+    return data
+
+def to_timestamps(dates):
+    # arrow-backed dates (see QUERY_SCHEMAS) go through python dates, which every pandas version converts
+    if isinstance(dates.dtype, pd.ArrowDtype):
+        dates = dates.astype(object)
+    return pd.to_datetime(dates)
+
+def _read_query(engine, name, query, trace=None):
+    with engine.connect() as con:
+        if trace is None:
+            return apply_query_schema(pd.read_sql(sql=query, con=con), name)
+        with trace.stage(f"read_sql_{name}") as record:
+            data = apply_query_schema(pd.read_sql(sql=query, con=con), name)
+            record["rows"] = len(data)
+        return data
+
+def read_queries(con, queries, max_workers=QUERY_WORKERS, trace=None):
+    # each query runs on its own pooled connection, so the caller waits only for the slowest one
+    workers = min(max_workers, len(queries))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {name: executor.submit(_read_query, con.engine, name, query, trace) for name, query in queries.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+def get_font_file_name(font, suffix):
+    return os.path.join(ASSETS_DIR, "fonts", font.lower().replace(" ", "-") + suffix)
+
+def encode_font_css(source_file, embedded_file):
+    font_dir = os.path.dirname(source_file)
+
+    def embed(match):
+        with open(os.path.join(font_dir, match.group(1)), "rb") as file:
+            encoded = base64.b64encode(file.read()).decode()
+        return f"url(data:font/woff2;base64,{encoded})"
+
+    with open(source_file) as file:
+        css = re.sub(r"url\(([^)]+\.woff2)\)", embed, file.read())
+
+    # written atomically since parallel renders may encode the same font at once
+    temp_file = f"{embedded_file}.{os.getpid()}"
+    with open(temp_file, "w") as file:
+        file.write(css)
+    os.replace(temp_file, embedded_file)
+
+@functools.lru_cache(maxsize=None)
+def get_font_css(font):
+    # @font-face rules with the font files base64-encoded once and reused by every report
+    embedded_file = get_font_file_name(font, ".embedded.css")
+    if not os.path.exists(embedded_file):
+        source_file = get_font_file_name(font, ".css")
+        if not os.path.exists(source_file):
+            return None
+        encode_font_css(source_file, embedded_file)
+
+    with open(embedded_file) as file:
+        return file.read()
+
 def generate_custom_cmap(pal=["redyellowgreen", "indigo"], cmap_type=["discrete", "continuous"], n_colors=None):
+    from matplotlib.colors import LinearSegmentedColormap
+
     if pal == "redyellowgreen":
         LOW = "#FF5252"
         MEDIUM = "#FFC108"
@@ -39,14 +219,66 @@ def generate_custom_cmap(pal=["redyellowgreen", "indigo"], cmap_type=["discrete"
     color_list = [LOW, MEDIUM, HIGH]
     
     if cmap_type == "discrete":
-        return plt.cm.colors.LinearSegmentedColormap.from_list("cmap_discrete", color_list, N=n_colors)
+        return LinearSegmentedColormap.from_list("cmap_discrete", color_list, N=n_colors)
     elif cmap_type == "continuous":
-        return plt.cm.colors.LinearSegmentedColormap.from_list("cmap_continuous", color_list)
+        return LinearSegmentedColormap.from_list("cmap_continuous", color_list)
     else:
         raise ValueError("cmap_type must be one of: discrete, continuous")
 
 def get_cmap_hexcodes(cmap, n_colors):
-    return [matplotlib.colors.to_hex(cmap(i)) for i in range(n_colors)]
+    from matplotlib.colors import to_hex
+
+    return [to_hex(cmap(i)) for i in range(n_colors)]
+
+def get_score_hexcodes(score_min=0, score_max=10):
+    n_colors = score_max - score_min + 1
+    goodness_hexcodes = get_cmap_hexcodes(generate_custom_cmap("redyellowgreen", "discrete", n_colors=n_colors), n_colors=n_colors)
+    fitbit_hexcodes = get_cmap_hexcodes(generate_custom_cmap("indigo", "discrete", n_colors=n_colors), n_colors=n_colors)
+    return goodness_hexcodes, fitbit_hexcodes
+
+COLS_WIDTHS = {
+    "day": "3%",
+    "date": "9%",
+    "goodness": "5%",
+    "notes": "18%",
+    "phase1_activities": "20%",
+    "phase2_activities": "22%"
+}
+
+# participants whose activities need wider columns
+COLS_WIDTHS_OVERRIDES = {
+    "119": {"phase2_activities": "24%", "notes": "16%"}
+}
+
+PHASE2_HIDDEN_COLS = ["has_morning", "has_evening", "n_planned_activities", "n_completed_activities", "has_fitbit"]
+
+def get_cols_widths(pid, n_cols):
+    widths = {**COLS_WIDTHS, **COLS_WIDTHS_OVERRIDES.get(str(pid), {})}
+
+    phase1_cols_widths = {
+        "Day of week": widths["day"],
+        "Date": widths["date"],
+        "Goodness rating": widths["goodness"],
+        "Note": COLS_WIDTHS["notes"]
+    }
+    for i in range(0, n_cols):
+        phase1_cols_widths["temp" + str(i)] = widths["phase1_activities"]
+
+    phase2_cols_widths = {
+        "Day of week": widths["day"],
+        "Date": widths["date"],
+        "Goodness rating": widths["goodness"],
+        "Planned activities": widths["phase2_activities"],
+        "Completed activities": widths["phase2_activities"],
+        "Morning plan": widths["notes"],
+        "Evening note": widths["notes"]
+    }
+    return phase1_cols_widths, phase2_cols_widths
+
+def get_table_data(phase1_data, phase2_data, temp_cols):
+    phase1_table_data = phase1_data.filter(["Day of week", "Date", "Goodness rating"] + temp_cols + ["Note", "Steps", "Sleep"], axis=1)
+    phase2_table_data = phase2_data.drop(PHASE2_HIDDEN_COLS, axis=1)
+    return phase1_table_data, phase2_table_data
 
 def chunk_list(input_list, n):
     size = len(input_list) // n
@@ -62,20 +294,90 @@ def chunk_list(input_list, n):
 
     return result
 
-def abbreviate_day_of_week(data, col):
-    abbrev = data[col].case_when(
-        caselist=[
-            (data[col] == "Monday", "Mon"),
-            (data[col] == "Tuesday", "Tues"),
-            (data[col] == "Wednesday", "Weds"),
-            (data[col] == "Thursday", "Thurs"),
-            (data[col] == "Friday", "Fri"),
-            (data[col] == "Saturday", "Sat"),
-            (data[col] == "Sunday", "Sun")
-        ]
+def format_activity_columns(data, n, separator=", "):
+    # split delimited activity lists into `n` balanced columns of html list markup without per-row python loops
+    items = data.str.split(separator).explode()
+    items = items[items.notna() & (items != "")]
+
+    if items.empty:
+        return pd.DataFrame("", index=data.index, columns=range(n))
+
+    position = items.groupby(level=0).cumcount().to_numpy()
+    length = items.groupby(level=0).transform("size").to_numpy()
+
+    # same split as `chunk_list`: the first `length % n` chunks get one extra item
+    size = length // n
+    remainder = length % n
+    boundary = remainder * (size + 1)
+    chunk = np.where(
+        position < boundary,
+        position // (size + 1),
+        remainder + (position - boundary) // np.maximum(size, 1)
+    )
+
+    return (
+        ("-&nbsp;" + items)
+        .groupby([items.index, chunk])
+        .agg("<br>".join)
+        .unstack()
+        .reindex(index=data.index, columns=range(n))
+        .fillna("")
     )
+
+def format_activity_list(data, separator=", "):
+    return format_activity_columns(data, 1, separator=separator)[0]
+
+DAY_OF_WEEK_ABBREVIATIONS = {
+    "Monday": "Mon",
+    "Tuesday": "Tues",
+    "Wednesday": "Weds",
+    "Thursday": "Thurs",
+    "Friday": "Fri",
+    "Saturday": "Sat",
+    "Sunday": "Sun"
+}
+
+def abbreviate_day_of_week(data, col):
+    # on a categorical column this renames the seven categories rather than touching every row
+    abbrev = data[col].map(lambda day: DAY_OF_WEEK_ABBREVIATIONS.get(day, day))
     return abbrev
 
+def format_phase1_data(data, activity_names, n_cols):
+    data = data.copy()
+    cols_mapping = {}
+
+    if data.empty:
+        temp_cols = ["Completed activities"]
+    else:
+        data["Day of week"] = abbreviate_day_of_week(data, "Day of week")
+        data["Completed activities"] = resolve_activity_names(data["Completed activities"], activity_names, separator=",  ")
+
+        temp_cols = ["temp" + str(i) for i in range(0, n_cols)]
+        data[temp_cols] = format_activity_columns(data["Completed activities"], n=n_cols, separator=",  ").to_numpy()
+
+        for i, col in enumerate(temp_cols):
+            cols_mapping[col] = "Completed activities" if i == 0 else ""
+
+    cols_mapping["Day of week"] = "Day"
+    cols_mapping["Goodness rating"] = "Goodness"
+    return data, temp_cols, cols_mapping
+
+def format_phase2_data(data, activity_names):
+    data = data.copy()
+    if data.empty:
+        return data
+
+    data["Day of week"] = abbreviate_day_of_week(data, "Day of week")
+    data["Planned activities"] = format_activity_list(resolve_activity_names(data["Planned activities"], activity_names))
+    data["Completed activities"] = format_activity_list(resolve_activity_names(data["Completed activities"], activity_names))
+    return data
+
+def format_phase2_extra_data(data, activity_names):
+    data = data.copy()
+    if not data.empty:
+        data["activity_list"] = resolve_activity_names(data["activity_list"], activity_names)
+    return data
+
 def get_longest_streak(data, phase):
     if phase == 2:
         df = data.query("has_morning == 1 & has_evening == 1")
@@ -87,7 +389,7 @@ def get_longest_streak(data, phase):
         .filter(["Date"], axis=1)
         .drop_duplicates()
         .reset_index(drop=True)
-        .assign(streak_breaks = lambda x: x["Date"].diff() != pd.Timedelta("1d"))
+        .assign(streak_breaks = lambda x: to_timestamps(x["Date"]).diff() != pd.Timedelta("1d"))
         .assign(streak_groups = lambda x: x["streak_breaks"].cumsum())
         .groupby("streak_groups")
         .agg({"Date":"count"})
@@ -96,72 +398,139 @@ def get_longest_streak(data, phase):
     )
     return longest_streak
 
-def get_value_box_data(data, phase, extra_data=None):
-    if phase == 1:
-        if extra_data is None:
+VALUE_BOX_DESCRIPTIONS = {
+    1: {
+        "n_surveys": "Surveys completed",
+        "longest_streak_days": "Longest survey completion streak",
+        "avg_goodness": "Average goodness rating",
+        "n_activities": "Total activities logged",
+        "n_distinct_activities": "Unique activities logged",
+        "avg_activity_score": "Average activity rating",
+        "days_with_fitbit": "Days with valid Fitbit data",
+        "average_steps": "Average step count",
+        "average_sleep": "Average hours of sleep"
+    },
+    2: {
+        "n_morning_surveys": "Morning surveys completed",
+        "n_evening_surveys": "Evening surveys completed",
+        "longest_streak_days": "Longest survey completion streak",
+        "avg_goodness": "Average goodness rating",
+        "n_planned_activities": "Total activities planned",
+        "n_completed_activities": "Total activities completed",
+        "days_with_fitbit": "Days with valid Fitbit data",
+        "average_steps": "Average step count",
+        "average_sleep": "Average hours of sleep"
+    }
+}
+
+# counts are zero rather than missing for participants without any rows in a phase
+VALUE_BOX_COUNTS = {
+    1: ["n_surveys", "n_activities", "n_distinct_activities", "days_with_fitbit"],
+    2: ["n_morning_surveys", "n_evening_surveys", "n_planned_activities", "n_completed_activities", "days_with_fitbit"]
+}
+
+def get_longest_streaks(data):
+    days = data.filter(["pId", "Date"], axis=1).drop_duplicates().sort_values(["pId", "Date"])
+    dates = to_timestamps(days["Date"])
+
+    streak_breaks = (dates.diff() != pd.Timedelta("1d")) | (days["pId"] != days["pId"].shift())
+    streak_groups = streak_breaks.cumsum()
+
+    return days.groupby([days["pId"], streak_groups]).size().groupby(level=0).max()
+
+def _get_fitbit_averages(data):
+    fitbit_days = data[data["has_fitbit"] == 1].groupby("pId")
+    return pd.DataFrame({
+        "average_steps": fitbit_days["Steps"].mean().round(0),
+        "average_sleep": fitbit_days["Sleep"].mean().round(0)
+    })
+
+def _get_phase1_metrics(data, extra_data):
+    grouped = data.groupby("pId")
+    metrics = pd.DataFrame({
+        "n_surveys": grouped.size(),
+        "longest_streak_days": get_longest_streaks(data),
+        "avg_goodness": grouped["Goodness rating"].mean().round(1),
+        "days_with_fitbit": grouped["has_fitbit"].sum()
+    })
+    metrics = metrics.join(_get_fitbit_averages(data), how="outer")
+
+    extra_metrics = extra_data.set_index("pId").filter(["n_activities", "n_distinct_activities", "avg_activity_score"], axis=1)
+    return metrics.join(extra_metrics, how="outer")
+
+def _get_phase2_metrics(data):
+    grouped = data.groupby("pId")
+    metrics = pd.DataFrame({
+        "n_morning_surveys": (data["has_morning"] == 1).groupby(data["pId"]).sum(),
+        "n_evening_surveys": (data["has_evening"] == 1).groupby(data["pId"]).sum(),
+        "longest_streak_days": get_longest_streaks(data.query("has_morning == 1 & has_evening == 1")),
+        "avg_goodness": grouped["Goodness rating"].mean().round(1),
+        "n_planned_activities": grouped["n_planned_activities"].sum(),
+        "n_completed_activities": grouped["n_completed_activities"].sum(),
+        "days_with_fitbit": grouped["has_fitbit"].sum()
+    })
+    return metrics.join(_get_fitbit_averages(data), how="outer")
+
+def compute_value_box_metrics(phase1_data=None, phase1_extra_data=None, phase2_data=None, pids=None):
+    # every value box statistic for every participant and phase, as one tidy table of pId, phase, variable, value
+    phase_metrics = {}
+    if phase1_data is not None:
+        if phase1_extra_data is None:
             raise ValueError("Must supply 'extra' data for phase 1 value boxes")
-            
-        value_descriptions = [
-            "Surveys completed", 
-            "Longest survey completion streak", 
-            "Average goodness rating", 
-            "Total activities logged", 
-            "Unique activities logged", 
-            "Average activity rating",
-            "Days with valid Fitbit data",
-            "Average step count",
-            "Average hours of sleep"
-        ]	
-        
-        value_box_stats = pd.DataFrame({
-            "n_surveys": [data.shape[0]],
-            "longest_streak_days": [get_longest_streak(data, 1)],
-            "avg_goodness": [round(data["Goodness rating"].mean(), 1)],
-            "n_activities": [extra_data["n_activities"][0]],
-            "n_distinct_activities": [extra_data["n_distinct_activities"][0]],
-            "avg_activity_score": [extra_data["avg_activity_score"][0]],
-            "days_with_fitbit": [int(data["has_fitbit"].sum())],
-            "average_steps": [data[data["has_fitbit"] == 1]["Steps"].mean().round(0).astype(int) if not np.isnan(data[data["has_fitbit"] == 1]["Steps"].mean()) else np.nan],
-            "average_sleep": [data[data["has_fitbit"] == 1]["Sleep"].mean().round(0).astype(int) if not np.isnan(data[data["has_fitbit"] == 1]["Sleep"].mean()) else np.nan]
-        })
-        
-        value_box_stats = value_box_stats.fillna({"n_surveys": 0, "n_activities": 0, "n_distinct_activities": 0, "days_with_fitbit": 0, "avg_activity_score": np.NaN})
+        phase_metrics[1] = _get_phase1_metrics(phase1_data, phase1_extra_data)
+    if phase2_data is not None:
+        phase_metrics[2] = _get_phase2_metrics(phase2_data)
 
-    elif phase == 2:
-        value_descriptions = [
-            "Morning surveys completed", 
-            "Evening surveys completed", 
-            "Longest survey completion streak", 
-            "Average goodness rating", 
-            "Total activities planned", 
-            "Total activities completed",
-            "Days with valid Fitbit data",
-            "Average step count",
-            "Average hours of sleep"
-        ]
-        
-        value_box_stats = pd.DataFrame({
-            "n_morning_surveys": [data.query("has_morning == 1").shape[0]],
-            "n_evening_surveys": [data.query("has_evening == 1").shape[0]],
-            "longest_streak_days": [get_longest_streak(data, 2)],
-            "avg_goodness": [round(data["Goodness rating"].mean(), 1)],
-            "n_planned_activities": [int(data["n_planned_activities"].sum())],
-            "n_completed_activities": [int(data["n_completed_activities"].sum())],
-            "days_with_fitbit": [data["has_fitbit"].sum()],
-            "average_steps": [data[data["has_fitbit"] == 1]["Steps"].mean().round(0).astype(int) if not np.isnan(data[data["has_fitbit"] == 1]["Steps"].mean()) else np.nan],
-            "average_sleep": [data[data["has_fitbit"] == 1]["Sleep"].mean().round(0).astype(int) if not np.isnan(data[data["has_fitbit"] == 1]["Sleep"].mean()) else np.nan]
-        })
-
-        value_box_stats = value_box_stats.fillna({"n_surveys": 0, "n_activities": 0, "n_distinct_activities": 0, "days_with_fitbit": 0})
+    # a participant without rows in one phase still gets zero counts for it
+    if pids is None:
+        frames = [data for data in [phase1_data, phase1_extra_data, phase2_data] if data is not None]
+        pids = pd.unique(pd.concat([data["pId"].astype(str) for data in frames]))
 
-    else:
+    metrics = []
+    for phase, data in phase_metrics.items():
+        data = data.reindex([str(pid) for pid in pids])
+
+        data = (
+            data
+            .reindex(columns=VALUE_BOX_DESCRIPTIONS[phase].keys())
+            .fillna({col: 0 for col in VALUE_BOX_COUNTS[phase]})
+            .astype(float)
+            .rename_axis("pId")
+            .reset_index()
+            .melt(id_vars="pId", var_name="variable")
+            .assign(phase=phase)
+        )
+        metrics.append(data)
+
+    return pd.concat(metrics, ignore_index=True).filter(["pId", "phase", "variable", "value"], axis=1)
+
+def summarize_cohort_metrics(metrics):
+    return (
+        metrics
+        .assign(value=lambda x: x["value"].astype(float))
+        .groupby(["phase", "variable"], sort=False)["value"]
+        .agg(["count", "mean", "median", "min", "max"])
+        .reset_index()
+    )
+
+def get_value_box_data_from_metrics(metrics, phase):
+    if phase not in VALUE_BOX_DESCRIPTIONS:
         raise ValueError("Phase must be 1 or 2")
 
+    descriptions = VALUE_BOX_DESCRIPTIONS[phase]
+    value_box_stats = (
+        metrics[metrics["phase"] == phase]
+        .set_index("variable")["value"]
+        .reindex(descriptions.keys())
+        .astype(float)
+        .rename_axis("variable")
+        .reset_index()
+    )
+
     return (
         value_box_stats
-        .melt()
         .assign(value=lambda x: x["value"].map("{:,.1f}".format).str.replace(".0", "").str.replace("nan", "N/A"))
-        .assign(description=value_descriptions)
+        .assign(description=list(descriptions.values()))
         .assign(variable = lambda x: pd.Categorical(x["variable"], categories=x["variable"].tolist()))
         .assign(
             description_x = 0.05,
@@ -175,6 +544,177 @@ def get_value_box_data(data, phase, extra_data=None):
         )
     )
 
+def get_value_box_data(data, phase, extra_data=None):
+    if phase == 1:
+        if extra_data is None:
+            raise ValueError("Must supply 'extra' data for phase 1 value boxes")
+        metrics = compute_value_box_metrics(phase1_data=data.assign(pId=""), phase1_extra_data=extra_data.assign(pId=""), pids=[""])
+    elif phase == 2:
+        metrics = compute_value_box_metrics(phase2_data=data.assign(pId=""), pids=[""])
+    else:
+        raise ValueError("Phase must be 1 or 2")
+
+    return get_value_box_data_from_metrics(metrics, phase)
+
+def _new_phase_state():
+    return {
+        "n_surveys": 0,
+        "n_morning_surveys": 0,
+        "n_evening_surveys": 0,
+        "goodness_sum": 0.0,
+        "goodness_count": 0,
+        "days_with_fitbit": 0,
+        "steps_sum": 0.0,
+        "steps_count": 0,
+        "sleep_sum": 0.0,
+        "sleep_count": 0,
+        "current_streak": 0,
+        "longest_streak": 0,
+        "streak_last_date": None,
+        "n_planned_activities": 0,
+        "n_completed_activities": 0,
+        "activity_counts": {},
+        "activity_score_sum": 0.0,
+        "activity_score_count": 0
+    }
+
+def new_metric_state(pid):
+    # running totals behind every value box statistic, so interim reports only need to read the days added since the last update
+    return {"pid": str(pid), "last_date": None, "phases": {"1": _new_phase_state(), "2": _new_phase_state()}}
+
+def _update_streak(phase_state, dates):
+    for date in sorted(to_timestamps(pd.Series(dates)).dt.normalize().unique()):
+        last_date = phase_state["streak_last_date"]
+        if last_date is not None and date - pd.Timestamp(last_date) == pd.Timedelta("1d"):
+            phase_state["current_streak"] += 1
+        else:
+            phase_state["current_streak"] = 1
+        phase_state["longest_streak"] = max(phase_state["longest_streak"], phase_state["current_streak"])
+        phase_state["streak_last_date"] = date.date().isoformat()
+
+def _update_daily_totals(phase_state, data):
+    goodness = data["Goodness rating"].dropna()
+    fitbit_days = data[data["has_fitbit"] == 1]
+
+    phase_state["goodness_sum"] += float(goodness.sum())
+    phase_state["goodness_count"] += int(goodness.shape[0])
+    phase_state["days_with_fitbit"] += int(fitbit_days.shape[0])
+    phase_state["steps_sum"] += float(fitbit_days["Steps"].sum())
+    phase_state["steps_count"] += int(fitbit_days["Steps"].count())
+    phase_state["sleep_sum"] += float(fitbit_days["Sleep"].sum())
+    phase_state["sleep_count"] += int(fitbit_days["Sleep"].count())
+
+def update_metric_state(state, phase1_data, phase1_activities, phase2_data, until=None):
+    # fold in only the days after `state["last_date"]`; `until` marks the end of the window that was read, so
+    # days without any surveys still advance the state
+    phase1_state = state["phases"]["1"]
+    phase2_state = state["phases"]["2"]
+
+    if not phase1_data.empty:
+        phase1_state["n_surveys"] += int(phase1_data.shape[0])
+        _update_daily_totals(phase1_state, phase1_data)
+        _update_streak(phase1_state, phase1_data["Date"])
+
+    for row in phase1_activities.itertuples(index=False):
+        counts = phase1_state["activity_counts"]
+        counts[str(row.activityId)] = counts.get(str(row.activityId), 0) + int(row.n_activities)
+        phase1_state["activity_score_sum"] += 0.0 if pd.isna(row.score_sum) else float(row.score_sum)
+        phase1_state["activity_score_count"] += int(row.score_count)
+
+    if not phase2_data.empty:
+        phase2_state["n_morning_surveys"] += int((phase2_data["has_morning"] == 1).sum())
+        phase2_state["n_evening_surveys"] += int((phase2_data["has_evening"] == 1).sum())
+        phase2_state["n_planned_activities"] += int(phase2_data["n_planned_activities"].sum())
+        phase2_state["n_completed_activities"] += int(phase2_data["n_completed_activities"].sum())
+        _update_daily_totals(phase2_state, phase2_data)
+        _update_streak(phase2_state, phase2_data.query("has_morning == 1 & has_evening == 1")["Date"])
+
+    dates = pd.concat([to_timestamps(phase1_data["Date"]), to_timestamps(phase2_data["Date"])])
+    if until is not None:
+        state["last_date"] = (pd.Timestamp(until) - pd.Timedelta("1d")).date().isoformat()
+    elif not dates.empty:
+        state["last_date"] = dates.max().date().isoformat()
+    return state
+
+def _mean(total, count, decimals):
+    return round(total / count, decimals) if count else np.nan
+
+def get_metrics_from_state(state):
+    # the same tidy pId, phase, variable, value table as compute_value_box_metrics
+    phase1_state = state["phases"]["1"]
+    phase2_state = state["phases"]["2"]
+
+    phase_metrics = {
+        1: {
+            "n_surveys": phase1_state["n_surveys"],
+            "longest_streak_days": phase1_state["longest_streak"] or np.nan,
+            "avg_goodness": _mean(phase1_state["goodness_sum"], phase1_state["goodness_count"], 1),
+            "n_activities": sum(phase1_state["activity_counts"].values()),
+            "n_distinct_activities": len(phase1_state["activity_counts"]),
+            "avg_activity_score": _mean(phase1_state["activity_score_sum"], phase1_state["activity_score_count"], 1),
+            "days_with_fitbit": phase1_state["days_with_fitbit"],
+            "average_steps": _mean(phase1_state["steps_sum"], phase1_state["steps_count"], 0),
+            "average_sleep": _mean(phase1_state["sleep_sum"], phase1_state["sleep_count"], 0)
+        },
+        2: {
+            "n_morning_surveys": phase2_state["n_morning_surveys"],
+            "n_evening_surveys": phase2_state["n_evening_surveys"],
+            "longest_streak_days": phase2_state["longest_streak"] or np.nan,
+            "avg_goodness": _mean(phase2_state["goodness_sum"], phase2_state["goodness_count"], 1),
+            "n_planned_activities": phase2_state["n_planned_activities"],
+            "n_completed_activities": phase2_state["n_completed_activities"],
+            "days_with_fitbit": phase2_state["days_with_fitbit"],
+            "average_steps": _mean(phase2_state["steps_sum"], phase2_state["steps_count"], 0),
+            "average_sleep": _mean(phase2_state["sleep_sum"], phase2_state["sleep_count"], 0)
+        }
+    }
+
+    return pd.DataFrame([
+        {"pId": state["pid"], "phase": phase, "variable": variable, "value": value}
+        for phase, metrics in phase_metrics.items() for variable, value in metrics.items()
+    ])
+
+def refresh_metric_state(con, state, until=None):
+    since = None
+    if state["last_date"] is not None:
+        since = (pd.Timestamp(state["last_date"]) + pd.Timedelta("1d")).date().isoformat()
+
+    queries = generate_queries(pid=state["pid"], dialect=con.dialect.name, since=since, until=until or LATEST_DATE)
+    data = read_queries(con, {name: queries[name] for name in ["phase1", "phase1_activities", "phase2"]})
+    return update_metric_state(state, data["phase1"], data["phase1_activities"], data["phase2"], until=until)
+
+def load_metric_state(file_name, pid=None):
+    if not os.path.exists(file_name):
+        return new_metric_state(pid)
+    with open(file_name) as file:
+        return json.load(file)
+
+def save_metric_state(state, file_name):
+    os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+    temp_file = f"{file_name}.tmp"
+    with open(temp_file, "w") as file:
+        json.dump(state, file, indent=2)
+    os.replace(temp_file, file_name)
+
+def register_bundled_fonts():
+    from matplotlib import font_manager
+
+    for font_file in sorted(glob(os.path.join(ASSETS_DIR, "fonts", "*.ttf"))):
+        font_manager.fontManager.addfont(font_file)
+
+@functools.lru_cache(maxsize=None)
+def resolve_plot_font(font):
+    # checking once per process avoids a font manager lookup and fallback warning for every text element
+    from matplotlib import font_manager
+
+    register_bundled_fonts()
+    available_fonts = {entry.name for entry in font_manager.fontManager.ttflist}
+    if font in available_fonts:
+        return font
+    if PLOT_FALLBACK_FONT in available_fonts:
+        return PLOT_FALLBACK_FONT
+    return font_manager.FontProperties().get_name()
+
 def create_value_box_plot(data, font="Ayuthaya"):
     INDIGO = "#3F51B5"
     WIDTH = 12
@@ -182,10 +722,13 @@ def create_value_box_plot(data, font="Ayuthaya"):
     NROW = 3
     NCOL = 3
 
+    import plotnine as p9
+
     MPL_FONTS = ["Avenir", "Ayuthaya", "Muna"]
     if not font in MPL_FONTS:
         print("Using default font")
         font = "Ayuthaya"
+    font = resolve_plot_font(font)
 
     plot = (
         p9.ggplot(data = data)
@@ -234,16 +777,43 @@ def create_value_box_plot(data, font="Ayuthaya"):
 
     return plot
 
+def create_value_box_html(data, font="Ayuthaya"):
+    # same layout as `create_value_box_plot`, emitted as a few lines of html/css instead of a rasterized figure
+    INDIGO = "#3F51B5"
+    NCOL = 3
+
+    boxes = "".join(
+        f'<div class="value-box"><div class="value-box-value">{escape_html(value)}</div>'
+        f'<div class="value-box-description">{escape_html(description)}</div></div>'
+        for value, description in zip(data["value"], data["description"])
+    )
+
+    style = f'''
+    <style>
+    .value-boxes {{ display: grid; grid-template-columns: repeat({NCOL}, 1fr); column-gap: 0.25%; width: 100%; font-family: "{font}", "Avenir", "Helvetica Neue", Arial, sans-serif; font-weight: bold; }}
+    .value-box {{ background-color: {INDIGO}; color: white; aspect-ratio: 4.3; padding: 0 1.25%; display: flex; flex-direction: column; justify-content: center; }}
+    .value-box-value {{ font-size: 2em; line-height: 1.2; }}
+    .value-box-description {{ font-size: 1.2em; opacity: 0.7; }}
+    </style>
+    '''
+
+    return f'{style}<div class="value-boxes">{boxes}</div>'
+
 def create_data_table(data, cols_labels, cols_widths, goodness_hexcodes, fitbit_hexcodes, font="Inconsolata", font_size=12, dashed=False, scrollable=False):
-    GOOGLE_FONT_OPTIONS = ["Inconsolata", "Source Code Pro", "Space Mono", "Fira Mono"]
+    from great_tables import GT, google_font, loc, style
+
     if not font in GOOGLE_FONT_OPTIONS:
         print("Using default font")
         font="Inconsolata"
 
+    # fonts come from the local asset cache when available, so renders need no network access; the table only names
+    # a cached font and the page embeds its @font-face rules once (this great_tables version has no opt_css)
+    font_css = get_font_css(font)
+
     dt = (
         GT(data)
         .cols_label(cols_labels)
-        .opt_table_font(font=google_font(font))
+        .opt_table_font(font=font if font_css is not None else google_font(font))
         .data_color(
             columns=["Goodness rating"],
             palette=goodness_hexcodes,
@@ -292,66 +862,402 @@ def create_data_table(data, cols_labels, cols_widths, goodness_hexcodes, fitbit_
 
     return dt
 
-def generate_queries(pid):
+# indexes the report queries rely on so that their cost scales with one participant's data, not with table size
+EXPECTED_INDEXES = [
+    "create index idx_user_study_phases_pid_phase on user_study_phases (pId, phaseId)",
+    "create index idx_survey_responses_pid_date on survey_responses (pId, date, sId)",
+    "create index idx_survey_responses_survey on survey_responses (surveyId)",
+    "create index idx_survey_response_details_survey on survey_response_details (surveyId, activityId)",
+    "create index idx_fitbit_data_pid_date on fitbit_data (pId, date, fitbitDataType)",
+    "create index idx_user_activity_preferences_phase on user_activity_preferences (participantPhaseId)"
+]
+
+def _get_text_color(hexcode):
+    from matplotlib.colors import to_rgb
+
+    # black or white text, whichever has the higher contrast ratio against the cell color
+    def luminance(rgb):
+        linear = [c / 12.92 if c <= 0.03928 else ((c + 0.055) / 1.055) ** 2.4 for c in rgb]
+        return 0.2126 * linear[0] + 0.7152 * linear[1] + 0.0722 * linear[2]
+
+    background = luminance(to_rgb(hexcode))
+    return "#000000" if (background + 0.05) / 0.05 > 1.05 / (background + 0.05) else "#FFFFFF"
+
+# steps and sleep are continuous, so the html renderers interpolate this many colors along the fitbit palette and give
+# each value the nearest one, which matches the color `data_color` blends for it to within rgb rounding
+FITBIT_PALETTE_STEPS = 1001
+
+def _interpolate_hexcodes(hexcodes, n_colors):
+    # evenly spaced colors along the palette, blended linearly in rgb between neighbouring hexcodes as `data_color` does
+    rgb = np.array([[int(hexcode[i:i + 2], 16) for i in (1, 3, 5)] for hexcode in hexcodes], dtype=float)
+    stops = np.linspace(0, 1, len(hexcodes))
+    positions = np.linspace(0, 1, n_colors)
+    channels = np.rint([np.interp(positions, stops, rgb[:, channel]) for channel in range(3)]).astype(int).T
+    return [f"#{r:02x}{g:02x}{b:02x}" for r, g, b in channels]
+
+def _get_palette_classes(values, n_colors, domain=None):
+    # index of the nearest of `n_colors` evenly spaced palette colors for each value; missing or out-of-domain values are uncolored
+    values = pd.to_numeric(values, errors="coerce").astype(float).to_numpy()
+    if domain is None:
+        domain = [np.nanmin(values), np.nanmax(values)] if not np.all(np.isnan(values)) else [0, 1]
+
+    span = domain[1] - domain[0]
+    scaled = (values - domain[0]) / span if span > 0 else np.zeros_like(values)
+    valid = ~np.isnan(values) & (scaled >= 0) & (scaled <= 1)
+
+    index = np.rint(np.where(valid, scaled, 0) * (n_colors - 1)).astype(int)
+    return np.where(valid, index, -1)
+
+def _format_cell(value, decimals=None):
+    if value is None or (isinstance(value, float) and np.isnan(value)) or value is pd.NA:
+        return ""
+    if decimals is not None:
+        return f"{value:,.{decimals}f}"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+HTML_TABLE_NUMBER_COLUMNS = ["Steps", "Sleep"]
+HTML_TABLE_BOLD_COLUMNS = ["Date", "Goodness rating"]
+
+def _get_html_table_style(data, goodness_hexcodes, fitbit_hexcodes, font, font_size, dashed):
+    # css and per-cell classes shared by the html renderers; palette colors are classes rather than inline styles,
+    # and only the colors the table uses get one. goodness ratings are whole numbers that each land on a palette color
+    fitbit_palette = _interpolate_hexcodes(fitbit_hexcodes, FITBIT_PALETTE_STEPS)
+    COLOR_COLUMNS = {
+        "Goodness rating": ("g", goodness_hexcodes, [0, 10]),
+        "Sleep": ("f", fitbit_palette, None),
+        "Steps": ("f", fitbit_palette, None)
+    }
+
+    cell_classes = {}
+    palette_classes = {}
+    for col in data.columns:
+        classes = np.full(data.shape[0], "b " if col in HTML_TABLE_BOLD_COLUMNS else "", dtype=object)
+        if col in COLOR_COLUMNS:
+            prefix, hexcodes, domain = COLOR_COLUMNS[col]
+            index = _get_palette_classes(data[col], len(hexcodes), domain)
+            classes = np.where(index >= 0, classes + prefix + index.astype(str), classes)
+            palette_classes.update({f"{prefix}{i}": hexcodes[i] for i in np.unique(index[index >= 0])})
+        if pd.api.types.is_numeric_dtype(data[col]):
+            classes = classes + " r"
+        cell_classes[col] = [cell_class.strip() for cell_class in classes.tolist()]
+
+    palette_css = [
+        f".balance-table .{cell_class} {{ background-color: {hexcode}; color: {_get_text_color(hexcode)}; }}"
+        for cell_class, hexcode in sorted(palette_classes.items())
+    ]
+
+    border_top = "border-top: 1px dashed black;" if dashed else "border-top: 1px solid #D3D3D3;"
+    css = f'''
+    .balance-table {{ width: 100%; table-layout: auto; border-collapse: collapse; font-family: "{font}", monospace; font-size: {font_size}px; color: #333333; border-top: 2px solid #A8A8A8; border-bottom: 2px solid #A8A8A8; }}
+    .balance-table th {{ font-size: {font_size + 2}px; font-weight: 700; text-align: left; padding: 5px; border-bottom: 2px solid #D3D3D3; vertical-align: bottom; }}
+    .balance-table td {{ padding: 8px 5px; {border_top} vertical-align: middle; }}
+    .balance-table .b {{ font-weight: bold; }}
+    .balance-table .r {{ text-align: right; }}
+    {chr(10).join(palette_css)}
+    '''
+
+    return css, cell_classes
+
+def _get_html_table_font_style(font):
+    # a style block of its own, identical in every report, so shared assets can hash it apart from the table's css
+    font_css = get_font_css(font)
+    if font_css is None:
+        font_css = f'@import url("https://fonts.googleapis.com/css2?family={font.replace(" ", "+")}&display=swap");'
+    return f"<style>{font_css}</style>"
+
+def _get_html_table_header(columns, cols_labels, cols_widths):
+    parts = ["<colgroup>"]
+    for col in columns:
+        parts.append(f'<col style="width: {cols_widths[col]}"/>' if col in cols_widths else "<col/>")
+    parts.append("</colgroup><thead><tr>")
+    for col in columns:
+        parts.append(f"<th>{cols_labels.get(col, col)}</th>")
+    parts.append("</tr></thead>")
+    return "".join(parts)
+
+def create_html_table(data, cols_labels, cols_widths, goodness_hexcodes, fitbit_hexcodes, font="Inconsolata", font_size=12, dashed=False, scrollable=False):
+    # same look as `create_data_table`, built as one string with shared css classes instead of per-cell inline styles
+    if not font in GOOGLE_FONT_OPTIONS:
+        print("Using default font")
+        font="Inconsolata"
+
+    css, cell_classes = _get_html_table_style(data, goodness_hexcodes, fitbit_hexcodes, font, font_size, dashed)
+    columns = data.columns.tolist()
+
+    parts = [_get_html_table_font_style(font), "<style>", css, "</style>"]
+    if scrollable:
+        parts.append('<div style="overflow-y: auto; height: 700px;">')
+    parts.append('<table class="balance-table">')
+    parts.append(_get_html_table_header(columns, cols_labels, cols_widths))
+    parts.append("<tbody>")
+
+    values = [data[col].tolist() for col in columns]
+    classes = [cell_classes[col] for col in columns]
+    decimals = [0 if col in HTML_TABLE_NUMBER_COLUMNS else None for col in columns]
+    for row in range(data.shape[0]):
+        parts.append("<tr>")
+        for col_values, col_classes, col_decimals in zip(values, classes, decimals):
+            attrs = f' class="{col_classes[row]}"' if col_classes[row] else ""
+            parts.append(f"<td{attrs}>{_format_cell(col_values[row], col_decimals)}</td>")
+        parts.append("</tr>")
+
+    parts.append("</tbody></table>")
+    if scrollable:
+        parts.append("</div>")
+
+    return "".join(parts)
+
+# renders only the rows inside the scrolled window (plus a margin), between spacer rows sized from the row offsets;
+# estimated row heights are replaced by measured ones as rows are drawn
+VIRTUAL_TABLE_SCRIPT = """
+(function () {
+  var container = document.getElementById("__TABLE_ID__");
+  var payload = JSON.parse(document.getElementById("__TABLE_ID__-data").textContent);
+  var tbody = container.querySelector("tbody");
+  var rows = payload.rows, classes = payload.classes, heights = payload.heights;
+  var overscan = 10, start = -1, end = -1, offsets = [];
+  // the container shrinks to fit short tables, so rows are drawn for its full maximum height
+  var viewHeight = parseFloat(window.getComputedStyle(container).maxHeight) || container.clientHeight;
+
+  function computeOffsets() {
+    offsets = [0];
+    for (var i = 0; i < heights.length; i++) offsets.push(offsets[i] + heights[i]);
+  }
+
+  function rowAt(y) {
+    var low = 0, high = rows.length;
+    while (low < high) {
+      var mid = (low + high) >> 1;
+      if (offsets[mid + 1] <= y) low = mid + 1; else high = mid;
+    }
+    return low;
+  }
+
+  function render(force) {
+    var top = container.scrollTop;
+    var s = Math.max(0, rowAt(top) - overscan);
+    var e = Math.min(rows.length, rowAt(top + viewHeight) + 1 + overscan);
+    if (!force && s === start && e === end) return;
+    start = s; end = e;
+
+    var html = ['<tr class="spacer" style="height: ' + offsets[s] + 'px"></tr>'];
+    for (var i = s; i < e; i++) {
+      html.push("<tr>");
+      for (var j = 0; j < rows[i].length; j++) {
+        var cellClass = classes[payload.cells[i][j]];
+        html.push(cellClass ? '<td class="' + cellClass + '">' : "<td>", rows[i][j], "</td>");
+      }
+      html.push("</tr>");
+    }
+    html.push('<tr class="spacer" style="height: ' + (offsets[rows.length] - offsets[e]) + 'px"></tr>');
+    tbody.innerHTML = html.join("");
+
+    var changed = false, rendered = tbody.children;
+    for (var k = 1; k < rendered.length - 1; k++) {
+      var measured = rendered[k].offsetHeight;
+      if (measured && measured !== heights[s + k - 1]) { heights[s + k - 1] = measured; changed = true; }
+    }
+    if (changed) {
+      computeOffsets();
+      rendered[rendered.length - 1].style.height = (offsets[rows.length] - offsets[e]) + "px";
+    }
+  }
+
+  var scheduled = false;
+  container.addEventListener("scroll", function () {
+    if (scheduled) return;
+    scheduled = true;
+    window.requestAnimationFrame(function () { scheduled = false; render(false); });
+  }, { passive: true });
+
+  computeOffsets();
+  render(true);
+})();
+"""
+
+def create_virtual_table(data, cols_labels, cols_widths, goodness_hexcodes, fitbit_hexcodes, font="Inconsolata", font_size=12, dashed=False, scrollable=True, height=700):
+    # same look as `create_html_table`, but the rows are embedded once as compact json and only the visible
+    # window is turned into table rows in the browser, so long tables stay light on phones and tablets;
+    # `scrollable` is accepted for parity with the other renderers, virtual tables always scroll once they are taller than
+    # `height`, and shorter ones shrink to fit
+    if not font in GOOGLE_FONT_OPTIONS:
+        print("Using default font")
+        font="Inconsolata"
+
+    css, cell_classes = _get_html_table_style(data, goodness_hexcodes, fitbit_hexcodes, font, font_size, dashed)
+    columns = data.columns.tolist()
+
+    # cell classes are stored once and referenced by index
+    class_names = sorted({cell_class for col in columns for cell_class in cell_classes[col]})
+    class_index = {cell_class: i for i, cell_class in enumerate(class_names)}
+
+    values = [data[col].tolist() for col in columns]
+    decimals = [0 if col in HTML_TABLE_NUMBER_COLUMNS else None for col in columns]
+    rows = [[_format_cell(col_values[row], col_decimals) for col_values, col_decimals in zip(values, decimals)] for row in range(data.shape[0])]
+    cells = [[class_index[cell_classes[col][row]] for col in columns] for row in range(data.shape[0])]
+
+    # first guess at each row's height from its line breaks; the browser corrects it once the row is drawn
+    line_height = round(font_size * 1.5)
+    heights = [max(cell.count("<br>") for cell in row) * line_height + line_height + 17 if row else line_height + 17 for row in rows]
+
+    payload = json.dumps({"rows": rows, "cells": cells, "classes": class_names, "heights": heights}, separators=(",", ":"))
+    payload = payload.replace("</", "<\\/")
+    table_id = "balance-table-" + hashlib.sha1(payload.encode()).hexdigest()[:10]
+
+    virtual_css = f"""
+    #{table_id} {{ overflow-y: auto; max-height: {height}px; -webkit-overflow-scrolling: touch; }}
+    #{table_id} thead th {{ position: sticky; top: 0; background-color: #FFFFFF; z-index: 1; }}
+    #{table_id} tr.spacer {{ border: none; }}
+    """
+
+    return "".join([
+        _get_html_table_font_style(font),
+        "<style>", css, virtual_css, "</style>",
+        f'<div id="{table_id}">',
+        '<table class="balance-table">',
+        _get_html_table_header(columns, cols_labels, cols_widths),
+        "<tbody></tbody></table></div>",
+        f'<script type="application/json" id="{table_id}-data">{payload}</script>',
+        "<script>", VIRTUAL_TABLE_SCRIPT.replace("__TABLE_ID__", table_id), "</script>"
+    ])
+
+ACTIVITY_REPLACEMENTS = (
+    ("Other activity(events, shopping,...)", "Other activity (events, shopping, ...)"),
+    ("social Media", "social media"),
+    ("Yard Work", "Yard work"),
+    ("Go to Therapy", "Go to therapy"),
+    ("Movve", "Move"),
+    ("Spending time", "Spend time"),
+    ("Playing Guitar", "Playing guitar"),
+    ("Weight Training", "Weight training"),
+    ("Strength Training", "Strength training"),
+    ("Word Searches", "Word searches"),
+    ("Internet Research", "Internet research"),
+    ("Outside Tasks", "Outside tasks"),
+    ("Ride Adventure Motorcycle", "Ride adventure motorcycle"),
+    ("Ride Dirt Bike", "Ride dirt bike"),
+    ("Ride Mountain Bike", "Ride mountain bike"),
+    ("Riding Bike", "Riding bike"),
+    ("Utv", "UTV")
+)
+
+ACTIVITY_ID_SEPARATOR = ","
+
+# cohort data entries that are shared by every participant rather than keyed by pId
+SHARED_COHORT_DATA = ["activity_names"]
+
+def load_activity_names(con, replacements=ACTIVITY_REPLACEMENTS):
+    query = '''
+    select activityId, name from user_activities
+    union all
+    select activityId, name from activities
+    '''
+    data = pd.read_sql(sql=text(query), con=con)
+
+    # capitalization and spelling fixes are applied once per distinct activity, not to every report row
+    names = data["name"].str.strip()
+    names = names.str[:1].str.upper() + names.str[1:]
+    for old, new in replacements:
+        names = names.str.replace(old, new, regex=False)
+
+    activity_names = pd.Series(names.values, index=data["activityId"].astype(str), name="activityName")
+    return activity_names[~activity_names.index.duplicated()]
+
+def resolve_activity_names(data, activity_names, separator=", "):
+    names = (
+        data
+        .str.split(ACTIVITY_ID_SEPARATOR)
+        .explode()
+        .map(activity_names)
+        .dropna()
+        .sort_values(key=lambda x: x.str.lower())
+    )
+    return names.groupby(level=0, sort=False).agg(separator.join).reindex(data.index)
+
+def _capitalize(col):
+    return f"concat(ucase(substring(trim(lower({col})), 1, 1)), substring(trim({col}), 2, length({col})))"
+
+def _group_concat(col, separator, dialect, distinct=False):
+    distinct_clause = "distinct " if distinct else ""
+    if dialect == "duckdb":
+        return f"string_agg({distinct_clause}{col}, '{separator}' order by {col})"
+    return f"group_concat({distinct_clause}{col} order by {col} separator '{separator}')"
+
+def _build_queries(pid_filter, participant_phase_filter, dialect, by_participant, interim=False):
+    # `pid_filter(table)` and `participant_phase_filter` are predicates with bound parameters;
+    # with `by_participant` every result is keyed by pId so that several participants can share one query;
+    # with `interim` phase windows are clipped to [:since, :until) and per-activity counts are added for the metric state
+    pid_select = "pid_goodness.pId as pId," if by_participant else ""
+    phase1_order = "pid_goodness.pId, pid_goodness.date" if by_participant else "pid_goodness.date"
+    phase1_extra_group = "group by pid_goodness.pId" if by_participant else ""
+    phase2_select = "pid_responses.pId as pId," if by_participant else ""
+    phase2_order = "pid_responses.pId, pid_responses.date" if by_participant else "pid_responses.date"
+    phase2_extra_select = "left(participantPhaseId, length(participantPhaseId) - 8) as pId," if by_participant else ""
+    phase2_extra_group = "group by participantPhaseId" if by_participant else ""
+
+    # activities are returned as IDs and resolved to display names in memory (see `resolve_activity_names`)
+    activity_id = "cast(activityId as char)"
+
+    start_date = "greatest(startDate, cast(:since as date))" if interim else "startDate"
+    end_date = "least(endDate, cast(:until as date))" if interim else "endDate"
+
+    def phase_windows(phase):
+        # resolve each participant's phase window once; the end date itself is excluded
+        return f'''
+    phase_windows as (
+        select pId, {start_date} as startDate, {end_date} - interval 1 day as endDate
+        from user_study_phases
+        where {pid_filter("user_study_phases")} and phaseId = '{phase}'
+    )'''
+
+    def fitbit_days():
+        # steps, sleep and heartrate validity in a single pass over the participant's fitbit rows
+        return f'''
+    fitbit_days as (
+        select
+            fitbit_data.pId,
+            date,
+            max(case when fitbitDataType = 'steps' then value end) as steps,
+            max(case when fitbitDataType = 'sleep' then value end) as sleep,
+            1 as has_fitbit
+        from fitbit_data
+        inner join phase_windows on fitbit_data.pId = phase_windows.pId
+        where
+            {pid_filter("fitbit_data")} and date >= startDate and date <= endDate and
+            fitbitDataType in ('steps', 'sleep', 'heartrate')
+        group by fitbit_data.pId, date
+        having max(case when fitbitDataType = 'heartrate' and value > 0 then 1 else 0 end) = 1
+    )'''
+
     phase1_query = f'''
-    with
+    with{phase_windows("PHASE_1")},
     pid_goodness as (
         select 
-            pId, 
+            survey_responses.pId, 
             dayname(date) as day, 
             date, 
             goodnessScore, 
-            concat(ucase(substring(trim(lower(note)), 1, 1)), substring(trim(note), 2)) as note_formatted
+            {_capitalize("note")} as note_formatted
         from survey_responses
-        where 
-            pId = "{pid}" and sId = "DAILY" and
-            date >= (select startDate from user_study_phases where pId = "{pid}" and phaseId = "PHASE_1") and
-            date <= (select date_sub(endDate, interval 1 day) from user_study_phases where pId = "{pid}" and phaseId = "PHASE_1")
-    ),
-    activity_names as (
-        select activityId, concat(ucase(substring(trim(lower(name)), 1, 1)), substring(trim(name), 2)) as activityName
-        from user_activities
-        union all
-        select activityId, concat(ucase(substring(trim(lower(name)), 1, 1)), substring(trim(name), 2)) as activityName		
-        from activities
+        inner join phase_windows on survey_responses.pId = phase_windows.pId
+        where {pid_filter("survey_responses")} and sId = 'DAILY' and date >= startDate and date <= endDate
     ),
     pid_activities as (
-        select pId, date, activityName
+        select survey_responses.pId, date, activityId
         from survey_response_details
-        left join survey_responses on survey_responses.surveyId = survey_response_details.surveyId
-        left join activity_names on activity_names.activityId = survey_response_details.activityId
+        inner join survey_responses on survey_responses.surveyId = survey_response_details.surveyId
+        inner join phase_windows on survey_responses.pId = phase_windows.pId
+        where {pid_filter("survey_responses")} and date >= startDate and date <= endDate
     ),
     pid_activities_list as (
-        select pId, date, group_concat(activityName order by activityName separator ",  ") as completedActivities
+        select pId, date, {_group_concat(activity_id, ACTIVITY_ID_SEPARATOR, dialect)} as completedActivities
         from pid_activities
         group by pId, date
-    ),
-    fitbit_days as (
-        select pId, date, 1 as has_fitbit 
-        from fitbit_data
-        where 
-            pId = "{pid}" and
-            date >= (select startDate from user_study_phases where pId = "{pid}" and phaseId = "PHASE_1") and
-            date <= (select date_sub(endDate, interval 1 day) from user_study_phases where pId = "{pid}" and phaseId = "PHASE_1") and
-            fitbitDataType = "heartrate" and value > 0 
-    ),
-    fitbit_steps as (
-        select pId, date, value as steps
-        from fitbit_data
-        where fitbitDataType = "steps"
-    ),
-    fitbit_sleep as (
-        select pId, date, value as sleep
-        from fitbit_data
-        where fitbitDataType = "sleep"
-    ),
-    fitbit_data as (
-        select fitbit_days.pId, fitbit_days.date, steps, sleep, has_fitbit
-        from fitbit_days
-        left join fitbit_steps on fitbit_days.pId = fitbit_steps.pId and fitbit_days.date = fitbit_steps.date
-        left join fitbit_sleep on fitbit_days.pId = fitbit_sleep.pId and fitbit_days.date = fitbit_sleep.date
-    )
+    ),{fitbit_days()}
     select
+        {pid_select}
         day as "Day of week",
         pid_goodness.date as "Date",
         goodnessScore as "Goodness rating",
@@ -362,115 +1268,86 @@ def generate_queries(pid):
         has_fitbit
     from pid_goodness
     left join pid_activities_list on pid_goodness.pId = pid_activities_list.pId and pid_goodness.date = pid_activities_list.date
-    left join fitbit_data on pid_goodness.pId = fitbit_data.pId and pid_goodness.date = fitbit_data.date;
+    left join fitbit_days on pid_goodness.pId = fitbit_days.pId and pid_goodness.date = fitbit_days.date
+    order by {phase1_order};
     '''
 
     phase1_extra_query = f'''
-    with
+    with{phase_windows("PHASE_1")},
     pid_goodness as (
-        select pId, dayname(date) as day, date, goodnessScore, concat(ucase(substring(trim(lower(note)), 1, 1)), substring(trim(note), 2)) as note_formatted
+        select survey_responses.pId, date
         from survey_responses
-        where
-            pId = "{pid}" and sId = "DAILY" and
-            date >= (select startDate from user_study_phases where pId = "{pid}" and phaseId = "PHASE_1") and
-            date <= (select date_sub(endDate, interval 1 day) from user_study_phases where pId = "{pid}" and phaseId = "PHASE_1")
+        inner join phase_windows on survey_responses.pId = phase_windows.pId
+        where {pid_filter("survey_responses")} and sId = 'DAILY' and date >= startDate and date <= endDate
     ),
     pid_activities as (
-        select pId, date, activityId, score
+        select survey_responses.pId, date, activityId, score
         from survey_response_details
-        left join survey_responses on survey_responses.surveyId = survey_response_details.surveyId
+        inner join survey_responses on survey_responses.surveyId = survey_response_details.surveyId
+        inner join phase_windows on survey_responses.pId = phase_windows.pId
+        where {pid_filter("survey_responses")} and date >= startDate and date <= endDate
     )
     select
+        {pid_select}
         count(activityId) as n_activities,
         count(distinct activityId) as n_distinct_activities,
         round(avg(case when score = -1 then null else score end), 1) as avg_activity_score
     from pid_goodness 
-    left join pid_activities on pid_goodness.pId = pid_activities.pId and pid_goodness.date = pid_activities.date;
+    left join pid_activities on pid_goodness.pId = pid_activities.pId and pid_goodness.date = pid_activities.date
+    {phase1_extra_group};
     '''
 
     phase2_query = f''' 
-    with
-    pid_responses as (
-        select distinct pid, dayname(date) as day, date
+    with{phase_windows("PHASE_2")},
+    pid_surveys as (
+        select survey_responses.pId, sId, date, goodnessScore, note
         from survey_responses
-        where 
-            pId = "{pid}" and sId in ("MORNING", "EVENING") and
-            date >= (select startDate from user_study_phases where pId = "{pid}" and phaseId = "PHASE_2") and
-            date <= (select date_sub(endDate, interval 1 day) from user_study_phases where pId = "{pid}" and phaseId = "PHASE_2")
+        inner join phase_windows on survey_responses.pId = phase_windows.pId
+        where {pid_filter("survey_responses")} and sId in ('MORNING', 'EVENING') and date >= startDate and date <= endDate
+    ),
+    pid_responses as (
+        select distinct pId, dayname(date) as day, date
+        from pid_surveys
     ),
     pid_goodness as (
-        select pId, date, goodnessScore, concat(ucase(substring(trim(lower(note)), 1, 1)), substring(trim(note), 2)) as evening_note_formatted, 1 as has_evening
-        from survey_responses
-        where 
-            pId = "{pid}" and sId = "EVENING" and
-            date >= (select startDate from user_study_phases where pId = "{pid}" and phaseId = "PHASE_2") and
-            date <= (select date_sub(endDate, interval 1 day) from user_study_phases where pId = "{pid}" and phaseId = "PHASE_2")
+        select pId, date, goodnessScore, {_capitalize("note")} as evening_note_formatted, 1 as has_evening
+        from pid_surveys
+        where sId = 'EVENING'
     ),
     pid_plan as (
-        select pId, date, concat(ucase(substring(trim(lower(note)), 1, 1)), substring(trim(note), 2)) as morning_note_formatted, 1 as has_morning
-        from survey_responses
-        where 
-            pId = "{pid}" and sId = "MORNING" and
-            date >= (select startDate from user_study_phases where pId = "{pid}" and phaseId = "PHASE_2") and
-            date <= (select date_sub(endDate, interval 1 day) from user_study_phases where pId = "{pid}" and phaseId = "PHASE_2")
+        select pId, date, {_capitalize("note")} as morning_note_formatted, 1 as has_morning
+        from pid_surveys
+        where sId = 'MORNING'
     ),
-    activity_names as (
-        select activityId, concat(ucase(substring(trim(lower(name)), 1, 1)), substring(trim(name), 2)) as activityName
-        from user_activities
-        union all
-        select activityId, concat(ucase(substring(trim(lower(name)), 1, 1)), substring(trim(name), 2)) as activityName		
-        from activities
+    pid_activities as (
+        select survey_responses.pId, date, survey_response_details.surveyId, activityId
+        from survey_response_details
+        inner join survey_responses on survey_responses.surveyId = survey_response_details.surveyId
+        inner join phase_windows on survey_responses.pId = phase_windows.pId
+        where {pid_filter("survey_responses")} and date >= startDate and date <= endDate
     ),
     pid_planned_activities as (
-        select distinct pId, date, activityName
-        from survey_response_details
-        left join survey_responses on survey_responses.surveyId = survey_response_details.surveyId
-        left join activity_names on activity_names.activityId = survey_response_details.activityId
-        where survey_response_details.surveyId like "%_MORNING_%"
+        select distinct pId, date, activityId
+        from pid_activities
+        where surveyId like '%_MORNING_%'
     ),
     pid_planned_activities_list as (
-        select pId, date, group_concat(activityName order by activityName separator ", ") as plannedActivities, count(activityName) as n_planned_activities
+        select pId, date, {_group_concat(activity_id, ACTIVITY_ID_SEPARATOR, dialect)} as plannedActivities, count(activityId) as n_planned_activities
         from pid_planned_activities
         group by pId, date
     ),
     pid_completed_activities as (
-        select distinct pId, date, activityName
-        from survey_response_details
-        left join survey_responses on survey_responses.surveyId = survey_response_details.surveyId
-        left join activity_names on activity_names.activityId = survey_response_details.activityId
-        where survey_response_details.surveyId like "%_EVENING_%"
+        select distinct pId, date, activityId
+        from pid_activities
+        where surveyId like '%_EVENING_%'
     ),
     pid_completed_activities_list as (
-        select pId, date, group_concat(activityName order by activityName separator ", ") as completedActivities, count(activityName) as n_completed_activities
+        select pId, date, {_group_concat(activity_id, ACTIVITY_ID_SEPARATOR, dialect)} as completedActivities, count(activityId) as n_completed_activities
         from pid_completed_activities
         group by pId, date
-    ),
-    fitbit_days as (
-        select pId, date, 1 as has_fitbit
-        from fitbit_data
-        where
-            pId = "{pid}" and
-            date >= (select startDate from user_study_phases where pId = "{pid}" and phaseId = "PHASE_2") and
-            date <= (select date_sub(endDate, interval 1 day) from user_study_phases where pId = "{pid}" and phaseId = "PHASE_2") and
-            fitbitDataType = "heartrate" and value > 0 
-    ),
-    fitbit_steps as (
-        select pId, date, value as steps
-        from fitbit_data
-        where fitbitDataType = "steps"
-    ),
-    fitbit_sleep as (
-        select pId, date, value as sleep
-        from fitbit_data
-        where fitbitDataType = "sleep"
-    ),
-    fitbit_data as (
-        select fitbit_days.pId, fitbit_days.date, steps, sleep, has_fitbit
-        from fitbit_days
-        left join fitbit_steps on fitbit_days.pId = fitbit_steps.pId and fitbit_days.date = fitbit_steps.date
-        left join fitbit_sleep on fitbit_days.pId = fitbit_sleep.pId and fitbit_days.date = fitbit_sleep.date
-    )
+    ),{fitbit_days()}
     select
+        {phase2_select}
         day as "Day of week",
         pid_responses.date as "Date",
         case when goodnessScore = -1 then null else goodnessScore end as "Goodness rating",
@@ -490,23 +1367,17 @@ def generate_queries(pid):
     left join pid_plan on pid_responses.pId = pid_plan.pId and pid_responses.date = pid_plan.date
     left join pid_planned_activities_list on pid_responses.pId = pid_planned_activities_list.pId and pid_responses.date = pid_planned_activities_list.date
     left join pid_completed_activities_list on pid_responses.pId = pid_completed_activities_list.pId and pid_responses.date = pid_completed_activities_list.date
-    left join fitbit_data on pid_responses.pId = fitbit_data.pId and pid_responses.date = fitbit_data.date
-    order by date;
+    left join fitbit_days on pid_responses.pId = fitbit_days.pId and pid_responses.date = fitbit_days.date
+    order by {phase2_order};
     '''
 
     phase2_extra_query = f''' 
-    with
-    activity_names as (
-        select activityId, concat(ucase(substring(trim(lower(name)), 1, 1)), substring(trim(name), 2)) as activityName
-        from user_activities
-        union all
-        select activityId, concat(ucase(substring(trim(lower(name)), 1, 1)), substring(trim(name), 2)) as activityName
-        from activities
-    )
-    select group_concat(distinct activityName order by activityName separator ', ') as activity_list
+    select 
+        {phase2_extra_select}
+        {_group_concat(activity_id, ACTIVITY_ID_SEPARATOR, dialect, distinct=True)} as activity_list
     from user_activity_preferences
-    left join activity_names on user_activity_preferences.activityId = activity_names.activityId
-    where participantPhaseId = "{pid}_PHASE_2";
+    where {participant_phase_filter}
+    {phase2_extra_group};
     '''
 
     qs = {
@@ -515,4 +1386,311 @@ def generate_queries(pid):
         "phase2": phase2_query,
         "phase2_extra": phase2_extra_query
     }
-    return qs
\ No newline at end of file
+
+    if interim:
+        activities_select = "survey_responses.pId as pId," if by_participant else ""
+        activities_group = "survey_responses.pId, activityId" if by_participant else "activityId"
+        qs["phase1_activities"] = f'''
+    with{phase_windows("PHASE_1")}
+    select
+        {activities_select}
+        {activity_id} as activityId,
+        count(*) as n_activities,
+        sum(case when score = -1 then null else score end) as score_sum,
+        count(case when score = -1 then null else score end) as score_count
+    from survey_response_details
+    inner join survey_responses on survey_responses.surveyId = survey_response_details.surveyId
+    inner join phase_windows on survey_responses.pId = phase_windows.pId
+    where {pid_filter("survey_responses")} and sId = 'DAILY' and date >= startDate and date <= endDate
+    group by {activities_group};
+    '''
+    return qs
+
+# open ends of an interim window
+EARLIEST_DATE = "1970-01-01"
+LATEST_DATE = "9999-12-31"
+
+def generate_queries(pid, dialect="mysql", since=None, until=None):
+    # `since` and `until` restrict the daily rows to [since, until) for incremental metric updates (see update_metric_state)
+    interim = since is not None or until is not None
+    qs = _build_queries(
+        pid_filter=lambda table: f"{table}.pId = :pid",
+        participant_phase_filter="participantPhaseId = :participant_phase_id",
+        dialect=dialect,
+        by_participant=False,
+        interim=interim
+    )
+
+    params = {"pid": pid, "participant_phase_id": f"{pid}_PHASE_2", "since": since or EARLIEST_DATE, "until": until or LATEST_DATE}
+    return {name: _bind_params(query, params) for name, query in qs.items()}
+
+def generate_cohort_queries(pids=None, dialect="mysql"):
+    if pids is None:
+        qs = _build_queries(
+            pid_filter=lambda table: "1 = 1",
+            participant_phase_filter="participantPhaseId like '%_PHASE_2'",
+            dialect=dialect,
+            by_participant=True
+        )
+        return {name: text(query) for name, query in qs.items()}
+
+    qs = _build_queries(
+        pid_filter=lambda table: f"{table}.pId in :pids",
+        participant_phase_filter="participantPhaseId in :participant_phase_ids",
+        dialect=dialect,
+        by_participant=True
+    )
+
+    params = {
+        "pids": [str(pid) for pid in pids],
+        "participant_phase_ids": [f"{pid}_PHASE_2" for pid in pids]
+    }
+    return {name: _bind_params(query, params) for name, query in qs.items()}
+
+def _bind_params(query, params):
+    statement = text(query)
+    bind_params = [
+        bindparam(key, value=value, expanding=isinstance(value, list))
+        for key, value in params.items() if f":{key}" in query
+    ]
+    return statement.bindparams(*bind_params)
+
+INTRADAY_FITBIT_TABLE = "fitbit_intraday_data"
+INTRADAY_CHUNKSIZE = 100000
+FITBIT_COLUMNS = ["Steps", "Sleep", "has_fitbit"]
+
+# minutes with a heart rate reading a day needs before the fitbit counts as worn
+MIN_WEAR_MINUTES = 600
+
+# asleep minutes further apart than this belong to separate sleep sessions
+SLEEP_SESSION_GAP = pd.Timedelta(minutes=60)
+
+def generate_intraday_fitbit_query(pids=None):
+    pid_filter = "pId in :pids" if pids is not None else "1 = 1"
+    # ordered so that each participant's sleep sessions arrive contiguously, even when they span chunks
+    query = f'''
+    with study_windows as (
+        select pId, min(startDate) as startDate, max(endDate) as endDate
+        from user_study_phases
+        where {pid_filter} and phaseId in ('PHASE_1', 'PHASE_2')
+        group by pId
+    )
+    select {INTRADAY_FITBIT_TABLE}.pId, dateTime, fitbitDataType, value
+    from {INTRADAY_FITBIT_TABLE}
+    inner join study_windows on {INTRADAY_FITBIT_TABLE}.pId = study_windows.pId
+    where
+        dateTime >= startDate - interval 12 hour and dateTime < endDate and
+        fitbitDataType in ('steps', 'sleep', 'heartrate')
+    order by {INTRADAY_FITBIT_TABLE}.pId, dateTime
+    '''
+    if pids is None:
+        return text(query)
+    return _bind_params(query, {"pids": [str(pid) for pid in pids]})
+
+def _aggregate_intraday_chunk(chunk):
+    timestamps = pd.to_datetime(chunk["dateTime"])
+    data_type = chunk["fitbitDataType"]
+    value = chunk["value"].astype(float)
+    pids = chunk["pId"].astype(str)
+    is_asleep = (data_type == "sleep") & (value > 0)
+
+    day_totals = pd.DataFrame({
+        "pId": pids,
+        "date": timestamps.dt.normalize(),
+        "steps": value.where(data_type == "steps", 0),
+        "wear_minutes": ((data_type == "heartrate") & (value > 0)).astype(int)
+    }).groupby(["pId", "date"]).sum()
+    return day_totals, pd.DataFrame({"pId": pids[is_asleep], "dateTime": timestamps[is_asleep]})
+
+def _close_sleep_sessions(asleep, open_session=None, final=False):
+    # each sleep session is credited to the day it ends on, as in fitbit's daily summaries, so a nap stays on its own day
+    # and a night's sleep goes to the next morning; the last session of a chunk may carry on into the next chunk, so its
+    # minutes are held back until a later session starts or the stream ends
+    if open_session is not None:
+        asleep = pd.concat([open_session, asleep], ignore_index=True)
+    if asleep is None or asleep.empty:
+        return None, None
+
+    starts = (asleep["pId"] != asleep["pId"].shift()) | (asleep["dateTime"].diff() > SLEEP_SESSION_GAP)
+    session = starts.cumsum()
+    is_open = (session == session.iloc[-1]) & (not final)
+    closed = asleep[~is_open]
+
+    sleep_minutes = (
+        closed
+        .assign(date=closed.groupby(session[~is_open])["dateTime"].transform("max").dt.normalize())
+        .groupby(["pId", "date"])
+        .size()
+        .to_frame("sleep_minutes")
+    )
+    return sleep_minutes, asleep[is_open] if is_open.any() else None
+
+def aggregate_intraday_fitbit(con, pids=None, chunksize=INTRADAY_CHUNKSIZE, min_wear_minutes=MIN_WEAR_MINUTES):
+    # per-day totals are additive, so memory is bounded by the number of days rather than the number of minute-level records
+    totals = None
+    open_session = None
+    with connect_for_streaming(con) as stream_con:
+        for chunk in pd.read_sql(sql=generate_intraday_fitbit_query(pids), con=stream_con, chunksize=chunksize):
+            day_totals, asleep = _aggregate_intraday_chunk(chunk)
+            sleep_minutes, open_session = _close_sleep_sessions(asleep, open_session)
+            for partial in [day_totals, sleep_minutes]:
+                if partial is not None:
+                    totals = partial if totals is None else totals.add(partial, fill_value=0)
+
+    sleep_minutes, _ = _close_sleep_sessions(None, open_session, final=True)
+    if sleep_minutes is not None:
+        totals = totals.add(sleep_minutes, fill_value=0)
+
+    if totals is None:
+        return pd.DataFrame(columns=["pId", "Date", "Steps", "Sleep", "wear_minutes", "sleep_minutes", "has_fitbit"])
+
+    # like the daily summaries, days the fitbit was not worn have no steps or sleep
+    totals = totals.reindex(columns=["steps", "wear_minutes", "sleep_minutes"]).fillna(0)
+    totals = totals[totals["wear_minutes"] >= min_wear_minutes].reset_index()
+    return pd.DataFrame({
+        "pId": totals["pId"],
+        "Date": totals["date"].dt.date,
+        "Steps": totals["steps"],
+        "Sleep": (totals["sleep_minutes"] / 60).round(1),
+        "wear_minutes": totals["wear_minutes"].astype(int),
+        "sleep_minutes": totals["sleep_minutes"].astype(int),
+        "has_fitbit": 1
+    })
+
+def apply_intraday_fitbit(data, fitbit_days):
+    # swap the daily fitbit columns for ones aggregated from intraday records, keeping the query's row and column order
+    keys = ["pId", "_day"] if "pId" in data.columns else ["_day"]
+    fitbit_days = fitbit_days.assign(_day=to_timestamps(fitbit_days["Date"]))
+    merged = (
+        data
+        .drop(columns=FITBIT_COLUMNS)
+        .assign(_day=to_timestamps(data["Date"]))
+        .merge(fitbit_days.filter(keys + FITBIT_COLUMNS, axis=1), on=keys, how="left")
+    )
+    return merged[data.columns]
+
+def extract_cohort_data(con, pids=None, activity_names=None, fitbit_source="daily"):
+    queries = generate_cohort_queries(pids=pids, dialect=con.dialect.name)
+
+    cohort_data = read_queries(con, queries)
+    for data in cohort_data.values():
+        data["pId"] = data["pId"].astype(str)
+
+    if fitbit_source == "intraday":
+        fitbit_days = aggregate_intraday_fitbit(con, pids=pids)
+        for name in ["phase1", "phase2"]:
+            cohort_data[name] = apply_query_schema(apply_intraday_fitbit(cohort_data[name], fitbit_days), name)
+
+    if activity_names is None:
+        activity_names = load_activity_names(con)
+    cohort_data["activity_names"] = activity_names
+
+    cohort_data["metrics"] = compute_value_box_metrics(
+        phase1_data=cohort_data["phase1"],
+        phase1_extra_data=cohort_data["phase1_extra"],
+        phase2_data=cohort_data["phase2"],
+        pids=pids
+    )
+
+    return cohort_data
+
+def get_participant_data(cohort_data, pid):
+    # aggregate queries return one row per participant even when there is nothing to aggregate
+    EXTRA_DEFAULTS = {
+        "phase1_extra": {"n_activities": 0, "n_distinct_activities": 0, "avg_activity_score": np.nan},
+        "phase2_extra": {"activity_list": None}
+    }
+
+    participant_data = {}
+    for name, data in cohort_data.items():
+        if name in SHARED_COHORT_DATA:
+            participant_data[name] = data
+            continue
+
+        pid_data = data[data["pId"] == str(pid)].drop(columns=["pId"]).reset_index(drop=True)
+        if pid_data.empty and name in EXTRA_DEFAULTS:
+            pid_data = apply_query_schema(pd.DataFrame([EXTRA_DEFAULTS[name]]), name)
+        participant_data[name] = pid_data
+    return participant_data
+
+def split_cohort_data(cohort_data, pids=None):
+    split_data = {}
+    for name, data in cohort_data.items():
+        if name in SHARED_COHORT_DATA:
+            continue
+        for pid, pid_data in data.groupby("pId", sort=False):
+            split_data.setdefault(pid, {})[name] = pid_data
+
+    if pids is not None:
+        for pid in pids:
+            split_data.setdefault(str(pid), {})
+    
+    # keep every query present so slices behave like a one-participant extraction
+    for pid_cohort_data in split_data.values():
+        for name, data in cohort_data.items():
+            if name in SHARED_COHORT_DATA:
+                pid_cohort_data[name] = data
+            else:
+                pid_cohort_data.setdefault(name, data.iloc[0:0])
+    return split_data
+
+def save_cohort_data(cohort_data, file_name):
+    pd.to_pickle(cohort_data, file_name)
+
+def load_cohort_data(file_name):
+    return pd.read_pickle(file_name)
+
+# how often memory is sampled while a traced stage runs
+STAGE_RSS_SAMPLE_SECONDS = 0.01
+
+def get_rss_mb():
+    # resident memory right now; ru_maxrss would be the high-water mark over the whole kernel's lifetime instead
+    return psutil.Process().memory_info().rss / 1024 ** 2
+
+@contextlib.contextmanager
+def sample_peak_rss(interval=STAGE_RSS_SAMPLE_SECONDS):
+    # samples resident memory on a background thread while the block runs, so memory that is allocated and freed
+    # again within the block still shows in record["peak_rss_mb"]
+    record = {"peak_rss_mb": get_rss_mb()}
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            record["peak_rss_mb"] = max(record["peak_rss_mb"], get_rss_mb())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield record
+    finally:
+        stop.set()
+        sampler.join()
+        record["peak_rss_mb"] = max(record["peak_rss_mb"], get_rss_mb())
+
+class ReportTrace:
+    def __init__(self, pid):
+        self.pid = str(pid)
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # callers can set record["rows"] inside the block
+        record = {"stage": name, "rows": None}
+        rss_start = get_rss_mb()
+        start = time.perf_counter()
+        try:
+            with sample_peak_rss() as peak:
+                yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            record["rss_mb"] = get_rss_mb()
+            record["rss_delta_mb"] = record["rss_mb"] - rss_start
+            record["peak_rss_mb"] = peak["peak_rss_mb"]
+            self.stages.append(record)
+
+    def to_dict(self):
+        return {"pid": self.pid, "stages": self.stages}
+
+    def save(self, file_name):
+        with open(file_name, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
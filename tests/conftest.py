@@ -0,0 +1,26 @@
+import os
+import sys
+import warnings
+
+import pytest
+
+# the scripts in src import each other as top-level modules, as they do when run from that directory
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, os.path.abspath(SRC_DIR))
+
+from generate_synthetic_data import generate_synthetic_data, write_synthetic_database
+
+N_PARTICIPANTS = 4
+N_DAYS = 20
+
+@pytest.fixture(autouse=True)
+def ignore_warnings():
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        yield
+
+@pytest.fixture
+def synthetic_database(tmp_path):
+    file_name = str(tmp_path / "synthetic.duckdb")
+    write_synthetic_database(generate_synthetic_data(N_PARTICIPANTS, N_DAYS), file_name)
+    return file_name
@@ -0,0 +1,13 @@
+from assemble_reports import assemble_report
+from utils import connect_to_snapshot, extract_cohort_data, get_participant_data
+
+def test_html_value_boxes_are_not_nested_in_a_grid(synthetic_database):
+    con = connect_to_snapshot(synthetic_database)
+    participant_data = get_participant_data(extract_cohort_data(con), "1000")
+    con.close()
+
+    report = assemble_report("1000", participant_data, value_boxes="html", tables="html")
+
+    # one grid per phase, from create_value_box_html itself
+    assert report.count('class="value-boxes"') == 2
+    assert report.count('class="value-box"') == 18
@@ -0,0 +1,62 @@
+import duckdb
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import create_engine
+
+from generate_synthetic_data import generate_synthetic_data, write_synthetic_database
+from snapshot import refresh_snapshot
+from utils import aggregate_intraday_fitbit, connect_to_snapshot, extract_cohort_data
+
+def minutes(pid, start, end, fitbitDataType):
+    times = pd.date_range(start, end, freq="min", inclusive="left")
+    return pd.DataFrame({"pId": pid, "dateTime": times, "fitbitDataType": fitbitDataType, "value": np.ones(len(times))})
+
+def test_naps_and_overnight_sleep_are_credited_to_the_day_they_end(tmp_path):
+    file_name = str(tmp_path / "intraday.duckdb")
+    phases = pd.DataFrame({
+        "pId": "1000", "phaseId": ["PHASE_1", "PHASE_2"],
+        "startDate": pd.to_datetime(["2024-01-01", "2024-01-02"]), "endDate": pd.to_datetime(["2024-01-02", "2024-01-04"])
+    })
+    intraday = pd.concat([
+        minutes("1000", f"2024-01-0{day} 07:00", f"2024-01-0{day} 23:00", "heartrate") for day in [1, 2, 3]
+    ] + [
+        minutes("1000", "2024-01-01 14:00", "2024-01-01 15:30", "sleep"),
+        minutes("1000", "2024-01-01 23:00", "2024-01-02 03:00", "sleep"),
+        minutes("1000", "2024-01-02 03:20", "2024-01-02 07:00", "sleep"),
+        minutes("1000", "2024-01-02 13:00", "2024-01-02 14:00", "sleep")
+    ], ignore_index=True).sample(frac=1, random_state=0)
+
+    with duckdb.connect(file_name) as con:
+        con.execute("create table user_study_phases as select * from phases")
+        con.execute("create table fitbit_intraday_data as select * from intraday")
+
+    con = connect_to_snapshot(file_name)
+    # chunks far smaller than a night, so sessions span several of them
+    fitbit_days = aggregate_intraday_fitbit(con, chunksize=97)
+    con.close()
+
+    assert fitbit_days["Date"].astype(str).tolist() == ["2024-01-01", "2024-01-02", "2024-01-03"]
+    assert fitbit_days["Sleep"].tolist() == [1.5, 8.7, 0.0]
+
+def test_snapshot_mirrors_intraday_records(tmp_path):
+    source_file = str(tmp_path / "source.duckdb")
+    snapshot_file = str(tmp_path / "snapshot.duckdb")
+    write_synthetic_database(generate_synthetic_data(2, 6, intraday=True), source_file)
+
+    engine = create_engine(f"duckdb:///{source_file}")
+    with engine.connect() as con:
+        n_rows = refresh_snapshot(con, snapshot_file)
+        n_rows_again = refresh_snapshot(con, snapshot_file, lookback_days=1)
+    engine.dispose()
+    assert n_rows["fitbit_intraday_data"] > n_rows_again["fitbit_intraday_data"] > 0
+
+    cohort_data = {}
+    for file_name in [source_file, snapshot_file]:
+        con = connect_to_snapshot(file_name)
+        cohort_data[file_name] = extract_cohort_data(con, fitbit_source="intraday")
+        con.close()
+
+    for name in ["phase1", "phase2"]:
+        pd.testing.assert_frame_equal(cohort_data[source_file][name], cohort_data[snapshot_file][name])
+    assert cohort_data[snapshot_file]["phase2"]["Sleep"].max() > 0
@@ -0,0 +1,18 @@
+import duckdb
+
+from utils import connect_to_snapshot, extract_cohort_data, get_participant_data, get_value_box_data_from_metrics
+
+def test_cohort_metrics_count_missing_phase_as_zero(synthetic_database):
+    with duckdb.connect(synthetic_database) as con:
+        con.execute("delete from survey_responses where pId = '1001' and sId in ('MORNING', 'EVENING')")
+
+    con = connect_to_snapshot(synthetic_database)
+    cohort_data = extract_cohort_data(con)
+    con.close()
+
+    assert "1001" not in cohort_data["phase2"]["pId"].tolist()
+    value_boxes = get_value_box_data_from_metrics(get_participant_data(cohort_data, "1001")["metrics"], phase=2)
+    values = value_boxes.set_index("variable")["value"]
+    assert values["n_morning_surveys"] == "0"
+    assert values["n_evening_surveys"] == "0"
+    assert values["avg_goodness"] == "N/A"
@@ -0,0 +1,88 @@
+import os
+import re
+import time
+
+import numpy as np
+import pytest
+import yaml
+
+import render_reports
+
+from render_reports import TEMPLATE_FILE, get_output_file
+from utils import ReportTrace, connect_to_snapshot, extract_cohort_data
+
+PIDS = ["1000", "1001"]
+
+def run_template_cells(render_dir, extra_args=None):
+    # stands in for quarto: runs the template's python cells in order, with params.yml applied after the
+    # parameters cell as the kernel would, and writes a placeholder report
+    with open(os.path.join(render_dir, TEMPLATE_FILE)) as file:
+        cells = re.findall(r"```\{python\}\n(.*?)```", file.read(), re.DOTALL)
+    with open(os.path.join(render_dir, "params.yml")) as file:
+        params = yaml.safe_load(file)
+
+    namespace = {}
+    for cell in cells:
+        exec(cell, namespace)
+        if "tags: [parameters]" in cell:
+            namespace.update(params)
+
+    os.makedirs(os.path.join(render_dir, "output"), exist_ok=True)
+    with open(os.path.join(render_dir, "output", get_output_file(params["pid"])), "w") as file:
+        file.write(f"<html>{params['pid']}</html>")
+
+def test_incremental_render_skips_unchanged_reports(synthetic_database, tmp_path, monkeypatch):
+    monkeypatch.setattr(render_reports, "run_quarto", run_template_cells)
+
+    con = connect_to_snapshot(synthetic_database)
+    cohort_data = extract_cohort_data(con, pids=PIDS)
+    con.close()
+
+    output_dir = str(tmp_path / "output")
+    manifest_file = str(tmp_path / "output" / "build_manifest.json")
+    params = {"value_boxes": "html", "tables": "gt"}
+    rendered = []
+
+    def render(on_result):
+        return render_reports.render_reports(
+            PIDS, workers=2, output_dir=output_dir, params=params, cohort_data=cohort_data,
+            manifest_file=manifest_file, on_result=on_result
+        )
+
+    assert render(lambda pid, error: rendered.append(pid)) == {}
+    assert sorted(rendered) == PIDS
+    assert all(os.path.exists(os.path.join(output_dir, get_output_file(pid))) for pid in PIDS)
+
+    rendered.clear()
+    assert render(lambda pid, error: rendered.append(pid)) == {}
+    assert rendered == []
+
+@pytest.mark.parametrize("tables", ["gt", "html", "virtual"])
+def test_template_cells_run_for_each_table_renderer(synthetic_database, tmp_path, monkeypatch, tables):
+    monkeypatch.setattr(render_reports, "run_quarto", run_template_cells)
+
+    params = {"value_boxes": "html", "tables": tables, "snapshot": synthetic_database}
+    output_path = render_reports.render_report("1000", str(tmp_path), params)
+    assert os.path.exists(output_path)
+
+def test_trace_records_stage_memory(synthetic_database, tmp_path, monkeypatch):
+    monkeypatch.setattr(render_reports, "run_quarto", run_template_cells)
+
+    trace_dir = str(tmp_path / "traces")
+    params = {"value_boxes": "html", "tables": "html", "snapshot": synthetic_database}
+    render_reports.render_report("1000", str(tmp_path), params, trace_dir=trace_dir)
+
+    hotspots = {hotspot["stage"]: hotspot for hotspot in render_reports.save_hotspots(trace_dir)}
+    assert {"read_sql", "phase1_table", "quarto_render", "write_output"} <= set(hotspots)
+    assert all(hotspot["max_rss_mb"] > 0 for hotspot in hotspots.values())
+    assert all(hotspot["max_peak_rss_mb"] > 0 for stage, hotspot in hotspots.items() if stage != "quarto_render")
+
+def test_trace_records_peak_of_memory_freed_within_a_stage():
+    trace = ReportTrace("1000")
+    with trace.stage("allocate_and_free"):
+        data = np.ones(50 * 1024 ** 2)
+        time.sleep(0.1)
+        del data
+
+    record = trace.stages[0]
+    assert record["peak_rss_mb"] - record["rss_mb"] > 300
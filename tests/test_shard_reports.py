@@ -0,0 +1,30 @@
+import shard_reports
+
+from render_reports import save_manifest
+from shard_reports import get_manifest_file, summarize_shards, work
+
+def test_retry_failed_returns_when_renders_keep_failing(tmp_path, monkeypatch):
+    work_dir = str(tmp_path / "shards")
+    shards = [
+        {"id": "shard-000", "pids": ["1000", "1001"], "estimated_cost": 400},
+        {"id": "shard-001", "pids": ["1002"], "estimated_cost": 200}
+    ]
+    save_manifest({"params": {}, "options": {}, "shards": shards}, get_manifest_file(work_dir))
+
+    rendered = []
+    def render_reports(pids, on_result=None, **kwargs):
+        rendered.extend(pids)
+        for pid in pids:
+            on_result(pid, "quarto failed")
+        return {pid: "quarto failed" for pid in pids}
+    monkeypatch.setattr(shard_reports, "render_reports", render_reports)
+
+    assert sorted(work(work_dir)) == ["1000", "1001", "1002"]
+    assert work(work_dir) == {}
+
+    # each failed participant is retried once per run, then the run ends
+    rendered.clear()
+    assert sorted(work(work_dir, retry_failed=True)) == ["1000", "1001", "1002"]
+    assert sorted(rendered) == ["1000", "1001", "1002"]
+    assert all(shard["failed"] == len(shard_pids["pids"]) and shard["claimed_by"] is None
+               for shard, shard_pids in zip(summarize_shards(work_dir), shards))
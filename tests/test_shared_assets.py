@@ -0,0 +1,27 @@
+import os
+
+import utils
+
+from shared_assets import SHARED_ASSETS_DIR, share_report_assets
+from test_tables import get_phase2_table_args
+
+FONT_CSS = '@font-face { font-family: "Inconsolata"; src: url(data:font/woff2;base64,' + "A" * 8192 + "); }"
+
+def test_table_font_is_shared_across_reports(synthetic_database, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "get_font_css", lambda font: FONT_CSS)
+    table_args = get_phase2_table_args(synthetic_database)
+
+    reports = []
+    for i, create_table in enumerate([utils.create_virtual_table, utils.create_html_table, utils.create_virtual_table]):
+        # a different row count per report, so each virtual table gets its own id
+        args = dict(table_args, data=table_args["data"].head(5 + i))
+        html_file = str(tmp_path / f"report_{i}.html")
+        with open(html_file, "w") as file:
+            file.write(f"<html><body>{create_table(**args)}</body></html>")
+        share_report_assets(html_file, str(tmp_path))
+        with open(html_file) as file:
+            reports.append(file.read())
+
+    style_files = [name for name in os.listdir(tmp_path / SHARED_ASSETS_DIR) if name.startswith("style.")]
+    assert len(style_files) == 1
+    assert all(f'{SHARED_ASSETS_DIR}/{style_files[0]}' in report and "@font-face" not in report for report in reports)
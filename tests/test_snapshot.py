@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+import duckdb
+
+from sqlalchemy import create_engine, text
+
+from snapshot import refresh_snapshot
+
+def count_rows(file_name, table):
+    with duckdb.connect(file_name, read_only=True) as con:
+        return con.execute(f"select count(*) from {table}").fetchone()[0]
+
+def test_refresh_picks_up_late_rows(synthetic_database, tmp_path):
+    snapshot_file = str(tmp_path / "snapshot.duckdb")
+    engine = create_engine(f"duckdb:///{synthetic_database}")
+
+    with engine.connect() as con:
+        refresh_snapshot(con, snapshot_file)
+
+        # a fitbit sync and a survey that arrive after the snapshot for a day it already holds
+        late_date = con.execute(text("select max(date) from fitbit_data")).scalar() - timedelta(days=2)
+        con.execute(text("insert into fitbit_data values ('1000', :date, 'calories', 2000)"), {"date": late_date})
+        con.execute(
+            text("insert into survey_responses values ('late_survey', '1000', 'DAILY', :date, 7, null)"),
+            {"date": late_date}
+        )
+        con.execute(text("insert into survey_response_details values ('late_survey', 'A0', 5)"))
+        con.commit()
+
+        n_rows = refresh_snapshot(con, snapshot_file, lookback_days=3)
+
+    engine.dispose()
+    for table in ["fitbit_data", "survey_responses", "survey_response_details"]:
+        assert n_rows[table] > 0
+        assert count_rows(snapshot_file, table) == count_rows(synthetic_database, table)
@@ -0,0 +1,57 @@
+import utils
+
+from utils import connect_to_snapshot, extract_cohort_data, format_phase2_data, get_cols_widths, get_participant_data, get_score_hexcodes, get_table_data
+
+FONT_CSS = '@font-face { font-family: "Inconsolata"; src: url(data:font/woff2;base64,AAAA); }'
+
+def get_phase2_table_args(synthetic_database):
+    con = connect_to_snapshot(synthetic_database)
+    participant_data = get_participant_data(extract_cohort_data(con), "1000")
+    con.close()
+
+    phase2_data = format_phase2_data(participant_data["phase2"], participant_data["activity_names"])
+    _, phase2_table_data = get_table_data(phase2_data, phase2_data, [])
+    goodness_hexcodes, fitbit_hexcodes = get_score_hexcodes()
+    return dict(
+        data=phase2_table_data,
+        cols_labels={"Day of week": "Day", "Goodness rating": "Goodness"},
+        cols_widths=get_cols_widths("1000", 3)[1],
+        goodness_hexcodes=goodness_hexcodes,
+        fitbit_hexcodes=fitbit_hexcodes
+    )
+
+def test_data_table_with_cached_font(synthetic_database, monkeypatch):
+    # the offline setup, once `assets.py fetch` has filled the font cache
+    monkeypatch.setattr(utils, "get_font_css", lambda font: FONT_CSS)
+
+    table = utils.create_data_table(**get_phase2_table_args(synthetic_database)).as_raw_html()
+    assert "Inconsolata" in table
+
+def test_short_virtual_table_shrinks_to_fit(synthetic_database):
+    table = utils.create_virtual_table(**get_phase2_table_args(synthetic_database), height=700)
+    assert "max-height: 700px" in table
+    assert " height: 700px" not in table
+
+def test_html_table_colors_match_data_color(synthetic_database):
+    import re
+
+    import numpy as np
+
+    from great_tables._data_color.palettes import GradientPalette
+
+    args = get_phase2_table_args(synthetic_database)
+    steps = args["data"]["Steps"].astype(float)
+    scaled = ((steps - steps.min()) / (steps.max() - steps.min())).tolist()
+    expected = GradientPalette(args["fitbit_hexcodes"])(scaled)
+
+    table = utils.create_html_table(**args)
+    colors = dict(re.findall(r"\.balance-table \.(f\d+) \{ background-color: (#[0-9a-f]{6})", table))
+    steps_col = list(args["data"].columns).index("Steps")
+    rows = re.findall(r"<tr>(.*?)</tr>", table.split("<tbody>")[1])
+    for row, color in zip(rows, expected):
+        cell_class = re.findall(r'<td(?: class="([^"]*)")?>', row)[steps_col]
+        if color is None:
+            continue
+        fitbit_class = [name for name in cell_class.split() if name.startswith("f")][0]
+        rgb = [int(colors[fitbit_class][i:i + 2], 16) - int(color[i:i + 2], 16) for i in (1, 3, 5)]
+        assert np.abs(rgb).max() <= 1
@@ -0,0 +1,22 @@
+import pandas as pd
+
+from utils import create_value_box_html, get_value_box_data
+
+def test_value_box_html_escapes_text():
+    phase2_data = pd.DataFrame({
+        "Date": pd.to_datetime(["2024-01-01", "2024-01-02"]).date,
+        "Goodness rating": [5, 7],
+        "Steps": [1000.0, None],
+        "Sleep": [7.0, None],
+        "has_morning": [1, 1],
+        "has_evening": [1, 0],
+        "n_planned_activities": [2, 1],
+        "n_completed_activities": [1, 0],
+        "has_fitbit": [1, 0]
+    })
+    data = get_value_box_data(phase2_data, phase=2)
+    data["description"] = data["description"].replace("Average step count", "Steps <per day>")
+
+    value_boxes = create_value_box_html(data)
+    assert "Steps &lt;per day&gt;" in value_boxes
+    assert value_boxes.count('class="value-box"') == 9